@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Measures the cold-start cost of importing the plug-in, as every labmanager
+process (including short-lived workers and CLI scripts) does for every
+configured RLMS. Each sample is taken in a fresh interpreter.
+
+It must be run in an environment where labmanager is importable:
+
+  $ python benchmarks/import_time.py [repetitions]
+
+Two scenarios are measured:
+ - lazy: importing the plug-in, as labmanager does when it starts.
+ - eager: importing the plug-in and then the forms, client and data
+   modules, which is what every process paid before they were lazily
+   loaded.
+
+The labmanager modules are imported before starting the timer, since they
+are imported anyway by the host process.
+"""
+
+import os
+import sys
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+PREPARE = """
+import labmanager.rlms, labmanager
+"""
+
+SCENARIOS = [
+    ('lazy', """
+import g4l_rlms_weblabdeusto
+"""),
+    ('eager', """
+import g4l_rlms_weblabdeusto
+import g4l_rlms_weblabdeusto.weblabdeusto_forms
+import g4l_rlms_weblabdeusto.weblabdeusto_client
+import g4l_rlms_weblabdeusto.weblabdeusto_data
+"""),
+]
+
+TEMPLATE = """
+import sys, time
+sys.path.insert(0, %(root)r)
+%(prepare)s
+t0 = time.time()
+%(code)s
+sys.stdout.write(repr(time.time() - t0))
+"""
+
+def measure(code, repetitions):
+    samples = []
+    for _ in range(repetitions):
+        script = TEMPLATE % dict(root = ROOT, prepare = PREPARE, code = code)
+        output = subprocess.check_output([ sys.executable, '-c', script ])
+        samples.append(float(output))
+    samples.sort()
+    return samples
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print "%-8s %10s %10s %10s" % ('scenario', 'min (ms)', 'median', 'max')
+    for name, code in SCENARIOS:
+        samples = measure(code, repetitions)
+        print "%-8s %10.2f %10.2f %10.2f" % (name, samples[0] * 1000, samples[len(samples) / 2] * 1000, samples[-1] * 1000)
+
+if __name__ == '__main__':
+    main()
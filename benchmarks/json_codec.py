@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark of the JSON work done per JSON-RPC method: encoding the
+request envelope and decoding a typical response, comparing the previous
+approach (json.dumps of the whole envelope, json.loads) with the codec
+used by the client (weblabdeusto_json), optionally with other backend.
+
+  $ python benchmarks/json_codec.py [iterations [json|simplejson|ujson]]
+"""
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from g4l_rlms_weblabdeusto import weblabdeusto_json
+
+RESERVATION_ID = {'id' : 'f1c3a0d4-8a5b-4c1e-9d3e-2b7e6f0a1c2d;f1c3a0d4-8a5b-4c1e-9d3e-2b7e6f0a1c2d.route1'}
+SESSION_ID     = {'id' : 'cd2b7a3e-5f4d-4e1a-8b9c-0d1e2f3a4b5c.route1'}
+
+def experiment(number):
+    return {
+        'experiment' : {
+            'name' : 'experiment-%s' % number,
+            'category' : { 'name' : 'Category %s' % (number % 10) },
+            'start_date' : '2013-01-01 00:00:00', 'end_date' : '2033-01-01 00:00:00',
+            'client' : { 'client_id' : 'js', 'configuration' : { 'html.file' : 'index.html', 'experiment.picture' : '/img/%s.png' % number } },
+        },
+        'time_allowed' : 200, 'priority' : 5, 'initialization_in_accounting' : False, 'permanent_id' : 'experiment-%s' % number,
+    }
+
+def command(number):
+    return {
+        'command' : { 'commandstring' : 'ChangeSwitch on %s' % (number % 10) },
+        'response' : { 'commandstring' : 'ok' },
+        'timestamp_before' : 1380000000.0 + number, 'timestamp_after' : 1380000000.5 + number,
+    }
+
+METHODS = [
+    # (method, params, response)
+    ('login', { 'username' : 'weblabfed', 'password' : 'password' },
+        { 'result' : SESSION_ID, 'is_exception' : False }),
+    ('list_experiments', { 'session_id' : SESSION_ID },
+        { 'result' : [ experiment(n) for n in range(100) ], 'is_exception' : False }),
+    ('reserve_experiment', {
+            'session_id' : SESSION_ID,
+            'experiment_id' : { 'exp_name' : 'ud-logic', 'cat_name' : 'PIC experiments' },
+            'client_initial_data' : '{}',
+            'consumer_data' : json.dumps({ 'user_agent' : 'Mozilla/5.0 (X11; Linux x86_64)', 'referer' : 'http://lms.example.org/course/1', 'from_ip' : '10.0.0.1', 'external_user' : 'student_university', 'time_allowed' : 200, 'priority' : 5 }),
+        },
+        { 'result' : { 'status' : 'Reservation::waiting', 'reservation_id' : RESERVATION_ID, 'position' : 3 }, 'is_exception' : False }),
+    ('get_reservation_status', { 'reservation_id' : RESERVATION_ID },
+        { 'result' : { 'status' : 'Reservation::confirmed', 'reservation_id' : RESERVATION_ID, 'time' : 200, 'initial_configuration' : '{}', 'url' : 'http://www.weblab.deusto.es/weblab/', 'remote_reservation_id' : RESERVATION_ID }, 'is_exception' : False }),
+    ('send_command', { 'reservation_id' : RESERVATION_ID, 'command' : { 'commandstring' : 'ChangeSwitch on 1' } },
+        { 'result' : { 'commandstring' : 'ok' }, 'is_exception' : False }),
+    ('get_experiment_uses_by_id', { 'session_id' : SESSION_ID, 'reservation_ids' : [ RESERVATION_ID ] * 10 },
+        { 'result' : [ { 'status' : 'finished', 'experiment_use' : { 'commands' : [ command(n) for n in range(100) ], 'sent_files' : [] } } ] * 10, 'is_exception' : False }),
+]
+
+RESERVATION_METHODS = ('get_reservation_status', 'finished_experiment')
+
+def measure(func, iterations):
+    t0 = time.time()
+    for _ in xrange(iterations):
+        func()
+    return (time.time() - t0) / iterations * 1e6
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    weblabdeusto_json.configure(sys.argv[2] if len(sys.argv) > 2 else None)
+    print "Backend: %s" % weblabdeusto_json.BACKEND
+    print "%-26s %12s %12s %12s %12s" % ('method (us/call)', 'encode old', 'encode new', 'decode old', 'decode new')
+    for method, params, response in METHODS:
+        content = json.dumps(response)
+
+        encode_old = measure(lambda : json.dumps({ 'method' : method, 'params' : params }), iterations)
+        if method in RESERVATION_METHODS:
+            encode_new = measure(lambda : weblabdeusto_json.encode_reservation_request(method, params['reservation_id']['id']), iterations)
+        else:
+            encode_new = measure(lambda : weblabdeusto_json.encode_request(method, params), iterations)
+
+        decode_iterations = max(1, iterations / max(1, len(content) / 1000))
+        decode_old = measure(lambda : json.loads(content), decode_iterations)
+        decode_new = measure(lambda : weblabdeusto_json.loads(content), decode_iterations)
+        print "%-26s %12.2f %12.2f %12.2f %12.2f" % (method, encode_old, encode_new, decode_old, decode_new)
+
+if __name__ == '__main__':
+    main()
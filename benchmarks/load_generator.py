@@ -0,0 +1,333 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Load generator for capacity planning of a gateway process. It starts a
+fake WebLab-Deusto server in this process (with configurable latency and
+error injection) and runs mixes of operations against it through the RLMS
+and WebLabDeustoClient classes, at a given rate and concurrency.
+
+It must be run in an environment where the LabManager is installed:
+
+  $ python benchmarks/load_generator.py --rate 50 --concurrency 10 --duration 30 \\
+            --latency 0.05 --jitter 0.02 --error-rate 0.01
+
+For each scenario it reports the throughput, the p50/p95/p99 latency of
+each operation and the memory used by the process. Increasing --rate until
+the achieved throughput stops growing (or the latency explodes) shows where
+a single gateway process saturates.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import resource
+import threading
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+#########################################################################
+#
+# Fake WebLab-Deusto server
+#
+
+class FaultInjection(object):
+
+    def __init__(self, latency = 0.0, jitter = 0.0, error_rate = 0.0, exception_rate = 0.0):
+        self.latency        = latency         # seconds added to every request
+        self.jitter         = jitter          # +- random seconds
+        self.error_rate     = error_rate      # ratio of HTTP 500 responses
+        self.exception_rate = exception_rate  # ratio of JSON-RPC exceptions
+
+    def delay(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+class FakeWebLabDeusto(object):
+
+    def __init__(self, laboratories = 50, commands_per_use = 100):
+        self.experiments = []
+        for number in range(laboratories):
+            self.experiments.append({
+                'experiment' : {
+                    'name' : 'experiment-%s' % number,
+                    'category' : { 'name' : 'Category %s' % (number % 5) },
+                    'client' : { 'client_id' : 'js', 'configuration' : {} },
+                },
+                'time_allowed' : 200,
+            })
+        self.commands_per_use = commands_per_use
+        self.reservations = {}
+        self.lock = threading.Lock()
+
+    def call(self, method, params):
+        return getattr(self, 'rpc_%s' % method)(**params)
+
+    def rpc_login(self, username, password):
+        return { 'id' : str(uuid.uuid4()) }
+
+    def rpc_list_experiments(self, session_id):
+        return self.experiments
+
+    def rpc_reserve_experiment(self, session_id, experiment_id, client_initial_data, consumer_data):
+        reservation_id = '%s;%s.route1' % (uuid.uuid4(), uuid.uuid4())
+        with self.lock:
+            self.reservations[reservation_id] = time.time()
+        return self._reservation(reservation_id)
+
+    def rpc_get_reservation_status(self, reservation_id):
+        return self._reservation(reservation_id['id'])
+
+    def rpc_finished_experiment(self, reservation_id):
+        with self.lock:
+            self.reservations.pop(reservation_id['id'], None)
+        return {}
+
+    def rpc_send_command(self, reservation_id, command):
+        return { 'commandstring' : 'ok' }
+
+    def rpc_get_experiment_uses_by_id(self, session_id, reservation_ids):
+        return [ self._experiment_use(reservation_id['id']) for reservation_id in reservation_ids ]
+
+    def _reservation(self, reservation_id):
+        with self.lock:
+            created = self.reservations.get(reservation_id, time.time())
+        if time.time() - created < 1:
+            return { 'status' : 'Reservation::waiting', 'reservation_id' : { 'id' : reservation_id }, 'position' : 1 }
+        return { 'status' : 'Reservation::confirmed', 'reservation_id' : { 'id' : reservation_id }, 'time' : 200, 'initial_configuration' : '{}', 'url' : 'http://localhost/', 'remote_reservation_id' : { 'id' : '' } }
+
+    def _experiment_use(self, reservation_id):
+        now = time.time()
+        commands = []
+        for number in range(self.commands_per_use):
+            commands.append({
+                'command' : { 'commandstring' : 'ChangeSwitch on %s' % (number % 10) },
+                'response' : { 'commandstring' : 'ok' },
+                'timestamp_before' : now + number, 'timestamp_after' : now + number + 0.1,
+            })
+        return {
+            'status' : 'finished',
+            'experiment_use' : {
+                'experiment_use_id' : 1, 'start_date' : now, 'end_date' : now + self.commands_per_use,
+                'from_ip' : '127.0.0.1', 'reservation_id' : reservation_id, 'request_info' : {},
+                'experiment_id' : { 'exp_name' : 'experiment-0', 'cat_name' : 'Category 0' },
+                'coord_address' : { 'machine_id' : 'machine', 'instance_id' : 'instance', 'server_id' : 'server' },
+                'commands' : commands, 'sent_files' : [],
+            }
+        }
+
+    def translations(self, category, experiment):
+        return { 'translations' : { 'en' : { 'title' : { 'value' : experiment } }, 'es' : { 'title' : { 'value' : experiment } } }, 'mails' : [] }
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+def start_fake_server(weblab, faults, port = 0):
+    """ start_fake_server(weblab, faults[, port]) -> (server, base_url) """
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.0'
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status, content):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.send_header('Set-Cookie', 'weblabsessionid=fake.route1; Path=/weblab/')
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_POST(self):
+            faults.delay()
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if random.random() < faults.error_rate:
+                return self._reply(500, 'Internal Server Error')
+            if random.random() < faults.exception_rate:
+                return self._reply(200, json.dumps({ 'is_exception' : True, 'code' : 'JSON:Server.UnexpectedError', 'message' : 'Injected error' }))
+            request = json.loads(body)
+            result = weblab.call(request['method'], request['params'])
+            self._reply(200, json.dumps({ 'is_exception' : False, 'result' : result }))
+
+        def do_GET(self):
+            faults.delay()
+            # /weblab/web/i18n/<category>/<experiment>/
+            parts = [ part for part in self.path.split('/') if part ]
+            if len(parts) != 5 or parts[1:3] != ['web', 'i18n']:
+                return self._reply(404, '{}')
+            if random.random() < faults.error_rate:
+                return self._reply(500, 'Internal Server Error')
+            self._reply(200, json.dumps(weblab.translations(parts[3], parts[4])))
+
+    server = _ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%s/weblab/' % server.server_address[1]
+
+#########################################################################
+#
+# Operations and scenarios
+#
+
+class Operations(object):
+
+    def __init__(self, base_url):
+        import g4l_rlms_weblabdeusto
+        from g4l_rlms_weblabdeusto.weblabdeusto_client import WebLabDeustoClient
+        from g4l_rlms_weblabdeusto.weblabdeusto_data import SessionId
+
+        self.base_url     = base_url
+        # Shared by all the threads, as RLMS does
+        self.client       = WebLabDeustoClient(base_url)
+        self.session_id_class = SessionId
+        self.rlms = g4l_rlms_weblabdeusto.RLMS(json.dumps({ 'remote_login' : 'loadtest', 'password' : 'password', 'base_url' : base_url }))
+        self.laboratories = [ laboratory.laboratory_id for laboratory in self.rlms.get_laboratories() ]
+        self.reservation_ids = []
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        laboratory_id = random.choice(self.laboratories)
+        user_properties = { 'user_agent' : 'load-generator', 'referer' : 'http://lms/', 'from_ip' : '127.0.0.1' }
+        result = self.rlms.reserve(laboratory_id, 'student', 'university', '{}', [], {}, user_properties, back = 'http://lms/', locale = 'en')
+        with self.lock:
+            self.reservation_ids.append(result['reservation_id'])
+            del self.reservation_ids[:-1000]
+
+    def _some_reservation_id(self):
+        with self.lock:
+            if self.reservation_ids:
+                return random.choice(self.reservation_ids)
+        self.reserve()
+        return self._some_reservation_id()
+
+    def poll_status(self):
+        self.client.get_reservation_status(self.session_id_class(self._some_reservation_id()))
+
+    def translations(self):
+        self.rlms.get_translations(random.choice(self.laboratories), random.choice(['en', 'es', 'es_ES']))
+
+    def usage(self):
+        session_id = self.client.login('loadtest', 'password')
+        self.client.get_experiment_uses_by_id(session_id, [ self.session_id_class(self._some_reservation_id()) for _ in range(10) ])
+
+    def load_widget(self):
+        self.rlms.load_widget(self._some_reservation_id(), 'default', back = 'http://lms/')
+
+SCENARIOS = {
+    # name : { operation : weight }
+    'exam-start' : { 'reserve' : 60, 'poll_status' : 30, 'translations' : 10 },
+    'exam'       : { 'reserve' : 10, 'poll_status' : 70, 'translations' : 10, 'load_widget' : 10 },
+    'browsing'   : { 'translations' : 80, 'load_widget' : 20 },
+    'reports'    : { 'usage' : 80, 'poll_status' : 20 },
+}
+
+def choose(weights):
+    total = sum(weights.values())
+    value = random.uniform(0, total)
+    for name, weight in sorted(weights.items()):
+        value -= weight
+        if value <= 0:
+            return name
+    return name
+
+def percentile(sorted_samples, ratio):
+    if not sorted_samples:
+        return float('nan')
+    position = min(len(sorted_samples) - 1, int(round(ratio * (len(sorted_samples) - 1))))
+    return sorted_samples[position]
+
+def run_scenario(operations, weights, rate, concurrency, duration):
+    """ run_scenario(...) -> { operation : (latencies, errors) }, elapsed
+
+    Operations are scheduled at a fixed rate (open model), so when the
+    process saturates the latency includes the time waiting for a worker.
+    """
+    results = dict( (name, ([], [0])) for name in weights )
+    results_lock = threading.Lock()
+    start = time.time()
+    counter = [0]
+    counter_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with counter_lock:
+                number = counter[0]
+                counter[0] += 1
+            scheduled = start + 1.0 * number / rate
+            if scheduled - start > duration:
+                return
+            wait = scheduled - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+            name = choose(weights)
+            error = False
+            try:
+                getattr(operations, name)()
+            except Exception:
+                error = True
+            latency = time.time() - scheduled
+            with results_lock:
+                results[name][0].append(latency)
+                if error:
+                    results[name][1][0] += 1
+
+    workers = [ threading.Thread(target = worker) for _ in range(concurrency) ]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results, time.time() - start
+
+def max_rss_mb():
+    # kilobytes in Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def main():
+    parser = argparse.ArgumentParser(description = "Load generator for the WebLab-Deusto RLMS plug-in")
+    parser.add_argument('--scenario', action = 'append', choices = sorted(SCENARIOS), help = "Scenario to run (default: all)")
+    parser.add_argument('--rate', type = float, default = 20, help = "Operations per second")
+    parser.add_argument('--concurrency', type = int, default = 10, help = "Worker threads")
+    parser.add_argument('--duration', type = float, default = 10, help = "Seconds per scenario")
+    parser.add_argument('--latency', type = float, default = 0.0, help = "Upstream latency (seconds)")
+    parser.add_argument('--jitter', type = float, default = 0.0, help = "Upstream latency jitter (seconds)")
+    parser.add_argument('--error-rate', type = float, default = 0.0, help = "Ratio of upstream HTTP 500 errors")
+    parser.add_argument('--exception-rate', type = float, default = 0.0, help = "Ratio of upstream JSON-RPC exceptions")
+    parser.add_argument('--laboratories', type = int, default = 50, help = "Laboratories in the fake server")
+    args = parser.parse_args()
+
+    faults = FaultInjection()
+    server, base_url = start_fake_server(FakeWebLabDeusto(args.laboratories), faults)
+    operations = Operations(base_url)
+    # Faults are only injected once the catalogue has been loaded
+    faults.latency, faults.jitter, faults.error_rate, faults.exception_rate = args.latency, args.jitter, args.error_rate, args.exception_rate
+
+    print "Fake WebLab-Deusto at %s; rate %s ops/s, concurrency %s, %s s per scenario" % (base_url, args.rate, args.concurrency, args.duration)
+    for scenario in args.scenario or sorted(SCENARIOS):
+        memory_before = max_rss_mb()
+        results, elapsed = run_scenario(operations, SCENARIOS[scenario], args.rate, args.concurrency, args.duration)
+        total = sum( len(latencies) for latencies, _ in results.values() )
+        errors = sum( errors[0] for _, errors in results.values() )
+        print
+        print "Scenario %s: %.1f ops/s (%s ops, %s errors), max RSS %.1f MB (+%.1f MB)" % (scenario, total / elapsed, total, errors, max_rss_mb(), max_rss_mb() - memory_before)
+        print "  %-14s %8s %8s %10s %10s %10s" % ('operation', 'count', 'errors', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)')
+        for name, (latencies, errors) in sorted(results.items()):
+            latencies.sort()
+            print "  %-14s %8s %8s %10.1f %10.1f %10.1f" % (name, len(latencies), errors[0], percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000, percentile(latencies, 0.99) * 1000)
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark of the URLs built by RLMS.reserve, RLMS.load_widget and
+RLMS.get_translations, comparing the previous string formatting (which
+did not encode the values) with the UrlBuilder, and of RLMS.list_widgets
+compared with the previous implementation (a plain lookup in
+WEBLABDEUSTO_LABS, which did not resolve the aliases of the mappings).
+
+It must be run in an environment where labmanager is importable:
+
+  $ python benchmarks/url_builder.py [iterations]
+"""
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from labmanager import app
+
+import g4l_rlms_weblabdeusto
+from g4l_rlms_weblabdeusto.weblabdeusto_urls import UrlBuilder
+from g4l_rlms_weblabdeusto.weblabdeusto_data import ExperimentId
+
+BASE_URL       = u'https://www.weblab.deusto.es/weblab/'
+RESERVATION_ID = u'f1c3a0d4-8a5b-4c1e-9d3e-2b7e6f0a1c2d;f1c3a0d4-8a5b-4c1e-9d3e-2b7e6f0a1c2d.route1'
+BACK           = u'http://lms.example.org/course/view.php?id=42&section=3'
+EXPERIMENT_ID  = ExperimentId(u'ud-logic', u'PIC experiments')
+
+LABS = dict( ('experiment-%s@Category' % number, [ dict(name = 'camera', description = 'Camera'), dict(name = 'controls', description = 'Controls') ]) for number in range(200) )
+MAPPINGS = dict( ('alias-%s@Category' % number, 'experiment-%s@Category' % number) for number in range(200) )
+
+def old_widget_url():
+    return "{}federated/?reservation_id={}&widget={}&back_url={}{}".format(BASE_URL, RESERVATION_ID, 'camera', BACK, "&locale=%s" % 'es')
+
+def old_translations_url():
+    translation_url = BASE_URL
+    if translation_url.endswith('/'):
+        translation_url += 'web/i18n/'
+    else:
+        translation_url += '/web/i18n/'
+    return translation_url + EXPERIMENT_ID.cat_name + '/' + EXPERIMENT_ID.exp_name + '/'
+
+def old_list_widgets(laboratory_id):
+    # As RLMS.list_widgets was before the widget lists were cached
+    labs = app.config.get('WEBLABDEUSTO_LABS', {})
+    default_widget = dict( name = 'default', description = 'Default widget')
+    return labs.get(laboratory_id, [ default_widget ])
+
+def measure(func, iterations):
+    t0 = time.time()
+    for _ in xrange(iterations):
+        func()
+    return (time.time() - t0) / iterations * 1e6
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    builder = UrlBuilder(BASE_URL)
+    app.config['WEBLABDEUSTO_LABS'] = LABS
+    rlms = g4l_rlms_weblabdeusto.RLMS(json.dumps({ 'remote_login' : 'user', 'password' : 'password', 'base_url' : BASE_URL, 'mappings' : json.dumps(MAPPINGS) }))
+
+    print "%-22s %14s %14s" % ('(us/call)', 'old', 'new')
+    print "%-22s %14.2f %14.2f" % ('load_widget url', measure(old_widget_url, iterations), measure(lambda : builder.widget_url(RESERVATION_ID, 'camera', BACK, 'es'), iterations))
+    print "%-22s %14.2f %14.2f" % ('translations url', measure(old_translations_url, iterations), measure(lambda : builder.translations_url(EXPERIMENT_ID), iterations))
+    for name, laboratory_id in [ ('list_widgets (lab)', 'experiment-5@Category'), ('list_widgets (other)', 'unknown@Category') ]:
+        print "%-22s %14.2f %14.2f" % (name, measure(lambda : old_list_widgets(laboratory_id), iterations), measure(lambda : rlms.list_widgets(laboratory_id), iterations))
+    # The previous implementation returned the default widget for aliases
+    print "%-22s %14s %14.2f" % ('list_widgets (alias)', '-', measure(lambda : rlms.list_widgets('alias-5@Category'), iterations))
+    print
+    print "Old: %s" % old_widget_url()
+    print "New: %s" % builder.widget_url(RESERVATION_ID, 'camera', BACK, 'es')
+
+if __name__ == '__main__':
+    main()
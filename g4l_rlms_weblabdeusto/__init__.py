@@ -1,97 +1,38 @@
 # -*-*- encoding: utf-8 -*-*-
 
-import sys
 import json
-import datetime
+import hashlib
+import threading
 
-from flask import request, Blueprint
-from flask.ext.wtf import TextField, PasswordField, Required, URL, ValidationError
+from flask import Blueprint
 
-from labmanager.forms import AddForm, RetrospectiveForm, GenericPermissionForm
 from labmanager.rlms import register, Laboratory, BaseRLMS, BaseFormCreator, register_blueprint, Capabilities, Versions
 from labmanager import app
 
-from .weblabdeusto_client import WebLabDeustoClient
-from .weblabdeusto_data import ExperimentId
-
-class WebLabDeustoAddForm(AddForm):
-
-    DEFAULT_URL      = 'http://www.weblab.deusto.es/'
-    DEFAULT_LOCATION = 'Bilbao, Spain'
-
-    remote_login = TextField("Login",        validators = [Required()])
-    password     = PasswordField("Password")
-
-    base_url     = TextField("Base URL",    validators = [Required(), URL(False) ])
-
-    mappings     = TextField("Mappings",     validators = [Required()], default = "{}")
-
-    def __init__(self, add_or_edit, *args, **kwargs):
-        super(WebLabDeustoAddForm, self).__init__(*args, **kwargs)
-        self.add_or_edit = add_or_edit
-
-    @staticmethod
-    def process_configuration(old_configuration, new_configuration):
-        old_configuration_dict = json.loads(old_configuration)
-        new_configuration_dict = json.loads(new_configuration)
-        if new_configuration_dict.get('password', '') == '':
-            new_configuration_dict['password'] = old_configuration_dict.get('password','')
-        return json.dumps(new_configuration_dict)
-
-    def validate_password(form, field):
-        if form.add_or_edit and field.data == '':
-            raise ValidationError("This field is required.")
-
-    def validate_mappings(form, field):
-        try:
-            content = json.loads(field.data)
-        except:
-            raise ValidationError("Invalid json content")
-        
-        if not isinstance(content, dict):
-            raise ValidationError("Dictionary expected")
-        
-        for key in content:
-            if not isinstance(key, basestring):
-                raise ValidationError("Keys must be strings")
-           
-            if '@' not in key:
-                raise ValidationError("Key format: experiment_name@experiment_category ")
-                
-            value = content[key]
-            if not isinstance(value, basestring):
-                raise ValidationError("Values must be strings")
-           
-            if '@' not in value:
-                raise ValidationError("Value format: experiment_name@experiment_category ")
-
-class WebLabDeustoPermissionForm(RetrospectiveForm):
-    priority = TextField("Priority")
-    time     = TextField("Time (in seconds)")
-
-    def validate_number(form, field):
-        if field.data != '' and field.data is not None:
-            try:
-                int(field.data)
-            except:
-                raise ValidationError("Invalid value. Must be an integer.")
-
-
-    validate_priority = validate_number
-    validate_time     = validate_number
-
-class WebLabDeustoLmsPermissionForm(WebLabDeustoPermissionForm, GenericPermissionForm):
-    pass
+# The forms (WTForms), the client (urllib2, cookielib) and the data classes
+# are imported on first use, since every labmanager process (including
+# short-lived workers and CLI scripts) imports all the RLMS plug-ins. They
+# are therefore not attributes of this package anymore: import them from
+# weblabdeusto_forms, weblabdeusto_client and weblabdeusto_data.
+from .weblabdeusto_catalogue import Catalogue, compile_mappings, compare_catalogues, notify_catalogue_changes, RefreshSchedule
+from .weblabdeusto_translations import TranslationIndex
+from .weblabdeusto_urls import get_url_builder
+from .weblabdeusto_reservations import ReservationTracker
+from . import weblabdeusto_tracing as tracing
+from . import weblabdeusto_json
 
 class WebLabFormCreator(BaseFormCreator):
 
     def get_add_form(self):
+        from .weblabdeusto_forms import WebLabDeustoAddForm
         return WebLabDeustoAddForm
 
     def get_permission_form(self):
+        from .weblabdeusto_forms import WebLabDeustoPermissionForm
         return WebLabDeustoPermissionForm
 
     def get_lms_permission_form(self):
+        from .weblabdeusto_forms import WebLabDeustoLmsPermissionForm
         return WebLabDeustoLmsPermissionForm
 
 FORM_CREATOR = WebLabFormCreator()
@@ -107,6 +48,9 @@ class RLMS(BaseRLMS):
         - password
         - base_url
 
+        Optionally, 'mappings' may contain a JSON-encoded dictionary of
+        aliases ({ "alias@category" : "experiment@category" }).
+
         A valid example of this would be:
         rlms = RLMS('{ "remote_login" : "weblabfed", "password" : "password", "base_url" : "https://www.weblab.deusto.es/weblab/" }')
         """
@@ -120,6 +64,13 @@ class RLMS(BaseRLMS):
         if self.login is None or self.password is None or self.base_url is None:
             raise Exception("Laboratory misconfigured: fields missing" )
 
+        self.mappings = compile_mappings(config.get('mappings'))
+        self.urls     = get_url_builder(self.base_url)
+        # The catalogue includes the aliases of the mappings, so each configuration has its own
+        if isinstance(configuration, unicode):
+            configuration = configuration.encode('utf8')
+        self.catalogue_key = 'catalogue:%s' % hashlib.sha1(configuration).hexdigest()
+
     def get_version(self):
         return Versions.VERSION_1
 
@@ -133,48 +84,183 @@ class RLMS(BaseRLMS):
             return ["Invalid configuration or server is down: %s" % e]
 
     def get_laboratories(self):
-        laboratories = WEBLAB_DEUSTO.rlms_cache.get('get_laboratories')
-        if laboratories:
-            return laboratories
-
-        client = WebLabDeustoClient(self.base_url)
-        session_id = client.login(self.login, self.password)
-        experiments = client.list_experiments(session_id)
-        laboratories = []
-        for experiment in experiments:
-            id = '%s@%s' % (experiment['experiment']['name'], experiment['experiment']['category']['name'])
-            laboratories.append(Laboratory(id, id))
-
-        WEBLAB_DEUSTO.rlms_cache['get_laboratories'] = laboratories
-        return laboratories
+        with tracing.span('get_laboratories'):
+            with tracing.span('cache'):
+                catalogue = WEBLAB_DEUSTO.rlms_cache.get(self.catalogue_key)
+            if catalogue:
+                return catalogue.laboratories
+
+            experiments = self._list_experiments()
+            with tracing.span('catalogue'):
+                return self._store_catalogue(experiments).laboratories
+
+    def refresh_laboratories(self):
+        """refresh_laboratories() -> CatalogueChanges
+
+        Retrieves the list of experiments and compares it with the one of
+        the previous refresh. Translations are only retrieved for those
+        laboratories which are new or have changed, and the cached
+        translations of the removed ones are dropped.
+
+        The previous fingerprints are kept in REFRESHED_FINGERPRINTS rather
+        than taken from the cached catalogue, which get_laboratories()
+        replaces whenever the cache evicts it.
+        """
+        experiments = self._list_experiments()
+
+        old_fingerprints = REFRESHED_FINGERPRINTS.get(self.configuration, {})
+        catalogue = self._store_catalogue(experiments)
+        changes = compare_catalogues(old_fingerprints, catalogue.fingerprints)
+        REFRESHED_FINGERPRINTS[self.configuration] = catalogue.fingerprints
+
+        from .weblabdeusto_data import ExperimentId
+        for laboratory_id in changes.removed:
+            translation_url = self.urls.translations_url(ExperimentId.parse(laboratory_id))
+            WEBLAB_DEUSTO.rlms_cache.pop(translation_url, None)
+            TRANSLATIONS.remove(translation_url)
+
+        # Aliases share the translations of their experiment
+        updated = set(changes.added + changes.changed)
+        for laboratory_id in catalogue.fingerprints:
+            if laboratory_id in updated:
+                self._retrieve_translations(self.urls.translations_url(catalogue.get_experiment_id(laboratory_id)))
+            else:
+                # Only goes to the server if the cache entry expired
+                self.get_translations(laboratory_id)
+
+        notify_catalogue_changes(changes)
+        return changes
+
+    def _create_client(self):
+        """Returns the WebLabDeustoClient of this configuration. It is thread-safe,
+        so it is shared by all the RLMS instances and threads of the process."""
+        key = (self.base_url, app.config.get('WEBLABDEUSTO_COMPRESS_REQUESTS_OVER'))
+        client = CLIENTS.get(key)
+        if client is None:
+            with CLIENTS_LOCK:
+                client = CLIENTS.get(key)
+                if client is None:
+                    from .weblabdeusto_client import WebLabDeustoClient
+                    client = CLIENTS[key] = WebLabDeustoClient(*key)
+        return client
+
+    def _get_session_store(self):
+        from .weblabdeusto_sessions import get_session_store
+        return get_session_store(app.config.get('WEBLABDEUSTO_SESSION_STORE') or 'memory://')
+
+    def _login(self, client):
+        """Returns the SessionId to be used by the client. The session is
+        shared by the threads of the process or, if a session store is
+        configured (WEBLABDEUSTO_SESSION_STORE), by all the processes of
+        the host, and only one of them logs in when there is no valid
+        session."""
+        store = self._get_session_store()
+
+        from .weblabdeusto_sessions import session_key
+        key = session_key(self.base_url, self.login)
+        stored = store.load(key)
+        if stored is None:
+            with store.lock(key):
+                # Other process might have logged in while waiting
+                stored = store.load(key)
+                if stored is None:
+                    session_id = client.login(self.login, self.password)
+                    store.save(key, session_id, client.get_cookies(session_id))
+                    return session_id
+
+        session_id, cookies = stored
+        client.set_cookies(cookies, session_id)
+        return session_id
+
+    def _call_with_session(self, func):
+        """Calls func(client, session_id). If the shared session expired, it
+        is discarded and the call is retried once with a new session."""
+        from .weblabdeusto_client import SessionNotFoundError
+
+        client = self._create_client()
+        with tracing.span('login'):
+            session_id = self._login(client)
+        try:
+            with tracing.span('http'):
+                return func(client, session_id)
+        except SessionNotFoundError:
+            from .weblabdeusto_sessions import session_key
+            self._get_session_store().invalidate(session_key(self.base_url, self.login), session_id)
+
+            with tracing.span('login'):
+                session_id = self._login(client)
+            with tracing.span('http'):
+                return func(client, session_id)
+
+    def _list_experiments(self):
+        return self._call_with_session(lambda client, session_id: client.list_experiments(session_id))
+
+    def _store_catalogue(self, experiments):
+        catalogue = Catalogue(experiments, Laboratory, self.mappings)
+        WEBLAB_DEUSTO.rlms_cache[self.catalogue_key] = catalogue
+        return catalogue
+
+    def _get_experiment_id(self, laboratory_id):
+        """Resolves the laboratory_id without contacting the server, using
+        the mappings of this configuration, the cached catalogue or the
+        identifier itself."""
+        experiment_id = self.mappings.resolve(laboratory_id)
+        if experiment_id is not None:
+            return experiment_id
+
+        catalogue = WEBLAB_DEUSTO.rlms_cache.get(self.catalogue_key)
+        if catalogue:
+            experiment_id = catalogue.get_experiment_id(laboratory_id)
+            if experiment_id is not None:
+                return experiment_id
+
+        from .weblabdeusto_data import ExperimentId
+        return ExperimentId.parse(laboratory_id)
 
     def get_check_urls(self, laboratory_id):
         return [ self.base_url ]
 
-    def get_translations(self, laboratory_id):
-        translations = WEBLAB_DEUSTO.rlms_cache.get(laboratory_id)
-        if translations:
-            return translations
+    def get_translations(self, laboratory_id, locale = None):
+        """get_translations(laboratory_id[, locale]) -> translations
 
-        experiment_name, category_name = laboratory_id.split('@')
-        translation_url = self.base_url
-        if translation_url.endswith('/'):
-            translation_url += 'web/i18n/'
-        else:
-            translation_url += '/web/i18n/'
-        translation_url += category_name + '/' + experiment_name + '/'
-        translations_r = WEBLAB_DEUSTO.cached_session.get(translation_url)
-        if translations_r.status_code == 404:
-            translations = { 'translations' : {}, 'mails' : {} }
-        else:
-            translations = translations_r.json()
-        WEBLAB_DEUSTO.rlms_cache[laboratory_id] = translations
+        If 'locale' is provided, only the messages of that locale (falling
+        back to the more generic ones, such as 'es_ES' -> 'es' -> 'en') are
+        returned, under the 'translations' key.
+
+        The translations are cached by their URL, which identifies the
+        server and the experiment, so aliases of different configurations
+        do not collide.
+        """
+        with tracing.span('get_translations'):
+            with tracing.span('cache'):
+                translation_url = self.urls.translations_url(self._get_experiment_id(laboratory_id))
+                translations = WEBLAB_DEUSTO.rlms_cache.get(translation_url)
+            if not translations:
+                translations = self._retrieve_translations(translation_url)
+
+            if locale is None:
+                return translations
+
+            with tracing.span('locale'):
+                return TRANSLATIONS.get(translation_url, locale, translations)
+
+    def _retrieve_translations(self, translation_url):
+        with tracing.span('http'):
+            translations_r = WEBLAB_DEUSTO.cached_session.get(translation_url)
+        with tracing.span('json'):
+            if translations_r.status_code == 404:
+                translations = { 'translations' : {}, 'mails' : {} }
+            else:
+                translations = translations_r.json()
+            translations = TRANSLATIONS.add(translation_url, translations)
+        WEBLAB_DEUSTO.rlms_cache[translation_url] = translations
         return translations
 
     def reserve(self, laboratory_id, username, institution, general_configuration_str, particular_configurations, request_payload, user_properties, *args, **kwargs):
-        client = WebLabDeustoClient(self.base_url)
-        session_id = client.login(self.login, self.password)
+        with tracing.span('reserve'):
+            return self._reserve(laboratory_id, username, institution, general_configuration_str, particular_configurations, request_payload, user_properties, **kwargs)
 
+    def _reserve(self, laboratory_id, username, institution, general_configuration_str, particular_configurations, request_payload, user_properties, **kwargs):
         consumer_data = {
             "user_agent"    : user_properties['user_agent'],
             "referer"       : user_properties['referer'],
@@ -188,50 +274,82 @@ class RLMS(BaseRLMS):
             if key in user_properties:
                 consumer_data[key] = user_properties[key]
 
-        if 'locale' in kwargs:
-            consumer_data['locale'] = kwargs['locale']
-            locale_string = "&locale=%s" % kwargs['locale']
-        else:
-            locale_string = ""
+        locale = kwargs.get('locale')
+        if locale is not None:
+            consumer_data['locale'] = locale
 
-        best_config = self._retrieve_best_configuration(general_configuration_str, particular_configurations)
+        with tracing.span('config'):
+            best_config = self._retrieve_best_configuration(general_configuration_str, particular_configurations)
+            experiment_id = self._get_experiment_id(laboratory_id)
 
         consumer_data.update(best_config)
 
-        consumer_data_str = json.dumps(consumer_data)
+        with tracing.span('json'):
+            consumer_data_str = weblabdeusto_json.dumps(consumer_data)
 
         initial_data = request_payload.get('initial', '{}') or '{}'
 
         if 'back' in kwargs:
             back = kwargs['back']
         else:
+            from flask import request
             back = request.referrer
 
-        reservation_status = client.reserve_experiment(session_id, ExperimentId.parse(laboratory_id), initial_data, consumer_data_str)
+        reservation_status = self._call_with_session(lambda client, session_id: client.reserve_experiment(session_id, experiment_id, initial_data, consumer_data_str))
+        RESERVATIONS.track(self.configuration, reservation_status.reservation_id.id, laboratory_id, consumer_data.get('time_allowed'))
+        with tracing.span('url'):
+            load_url = self.urls.load_url(reservation_status.reservation_id.id, back, locale)
         return {
             'reservation_id' : reservation_status.reservation_id.id,
-            'load_url' : "{}federated/?reservation_id={}&back_url={}{}".format(self.base_url, reservation_status.reservation_id.id, back, locale_string)
+            'load_url' : load_url
         }
 
     def load_widget(self, reservation_id, widget_name, **kwargs):
-        if 'back' in kwargs:
-            back = kwargs['back']
-        else:
-            back = request.referrer
-
-        if 'locale' in kwargs:
-            locale_string = "&locale=%s" % kwargs['locale']
-        else:
-            locale_string = ""
-
-        return {
-            'url' : "{}federated/?reservation_id={}&widget={}&back_url={}{}".format(self.base_url, reservation_id, widget_name, back, locale_string)
-        }
+        with tracing.span('load_widget'):
+            if 'back' in kwargs:
+                back = kwargs['back']
+            else:
+                from flask import request
+                back = request.referrer
+
+            with tracing.span('url'):
+                return {
+                    'url' : self.urls.widget_url(reservation_id, widget_name, back, kwargs.get('locale'))
+                }
+
+    def release_abandoned_reservations(self):
+        """release_abandoned_reservations() -> [ TrackedReservation ]
+
+        Releases the reservations of this configuration which WebLab-Deusto
+        reports as out of time. It only anticipates the expiry done by
+        WebLab-Deusto itself: abandoned reservations which still have time
+        left are not released.
+        """
+        return RESERVATIONS.sweep(self.configuration, self._create_client())
 
     def list_widgets(self, laboratory_id):
+        widgets = self._get_widgets().get(laboratory_id)
+        if widgets is None:
+            default_widget = dict( name = 'default', description = 'Default widget')
+            return [ default_widget ]
+        return widgets
+
+    def _get_widgets(self):
+        """Returns the WEBLABDEUSTO_LABS setting ({ laboratory_id : [ widget ] })
+        extended with the aliases of the mappings. It is cached per
+        configuration, and rebuilt if the setting is replaced."""
         labs = app.config.get('WEBLABDEUSTO_LABS', {})
-        default_widget = dict( name = 'default', description = 'Default widget')
-        return labs.get(laboratory_id, [ default_widget ])
+        cached = WIDGETS.get(self.configuration)
+        if cached is not None and cached[0] is labs:
+            return cached[1]
+
+        widgets = dict(labs)
+        for alias, experiment_id in self.mappings.iteritems():
+            target = experiment_id.to_weblab_str()
+            if alias not in widgets and target in labs:
+                widgets[alias] = labs[target]
+        WIDGETS[self.configuration] = (labs, widgets)
+        return widgets
 
     def _retrieve_best_configuration(self, general_configuration_str, particular_configurations):
         max_time     = None
@@ -272,12 +390,49 @@ class RLMS(BaseRLMS):
         return consumer_data
 
 
+# Translations sliced by (translation URL, locale), shared by all the configurations
+TRANSLATIONS = TranslationIndex()
+
+# configuration -> (WEBLABDEUSTO_LABS, { laboratory_id : [ widget ] })
+WIDGETS = {}
+
+# (base_url, compress_requests_over) -> WebLabDeustoClient
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+# Reservations issued by this process, until they finish
+RESERVATIONS = ReservationTracker()
+
+# configuration -> RefreshSchedule
+REFRESH_SCHEDULES = {}
+
+# configuration -> fingerprints of the catalogue of the last refresh
+REFRESHED_FINGERPRINTS = {}
+
 def populate_cache(rlms):
-    for laboratory in rlms.get_laboratories():
-        rlms.get_translations(laboratory.laboratory_id)
+    schedule = REFRESH_SCHEDULES.get(rlms.configuration)
+    if schedule is None:
+        schedule = REFRESH_SCHEDULES[rlms.configuration] = RefreshSchedule()
+
+    if not schedule.is_due():
+        return
+
+    with tracing.span('populate_cache'):
+        changes = rlms.refresh_laboratories()
+    schedule.update(changes.has_changes())
+
+def release_reservations(rlms):
+    rlms.release_abandoned_reservations()
+
+# WEBLABDEUSTO_TRACING: None (default), 'memory' (exposed in /weblabdeusto/traces/) or 'log'
+tracing.configure(app.config.get('WEBLABDEUSTO_TRACING'))
+# WEBLABDEUSTO_JSON_BACKEND: None (json, default), 'simplejson' or 'ujson'
+weblabdeusto_json.configure(app.config.get('WEBLABDEUSTO_JSON_BACKEND'))
 
 WEBLAB_DEUSTO = register("WebLab-Deusto", ['5.0'], __name__)
-WEBLAB_DEUSTO.add_local_periodic_task('Populating cache', populate_cache, minutes = 55)
+# The task runs often, but the RefreshSchedule decides when to actually refresh
+WEBLAB_DEUSTO.add_local_periodic_task('Populating cache', populate_cache, minutes = RefreshSchedule.MIN_INTERVAL / 60)
+WEBLAB_DEUSTO.add_local_periodic_task('Releasing abandoned reservations', release_reservations, minutes = 1)
 
 
 weblabdeusto_blueprint = Blueprint('weblabdeusto', __name__)
@@ -285,4 +440,17 @@ weblabdeusto_blueprint = Blueprint('weblabdeusto', __name__)
 def index():
     return "This is the index for WebLab-Deusto"
 
+@weblabdeusto_blueprint.route('/reservations/')
+def reservations():
+    from flask import jsonify
+    return jsonify(**RESERVATIONS.get_report())
+
+@weblabdeusto_blueprint.route('/traces/')
+def traces():
+    from flask import jsonify
+    exporter = tracing.get_exporter()
+    if not isinstance(exporter, tracing.RingBufferExporter):
+        return jsonify(enabled = False, spans = [])
+    return jsonify(enabled = True, spans = exporter.get_spans())
+
 register_blueprint(weblabdeusto_blueprint, '/weblabdeusto')
@@ -0,0 +1,248 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import hashlib
+
+def experiment_to_laboratory_id(experiment):
+    return '%s@%s' % (experiment['experiment']['name'], experiment['experiment']['category']['name'])
+
+def fingerprint_experiments(experiments):
+    """ fingerprint_experiments(experiments) -> { laboratory_id : fingerprint }
+
+    Given the result of list_experiments, it returns a short digest of each
+    experiment, so two catalogues can be compared without keeping the whole
+    list_experiments result around.
+    """
+    fingerprints = {}
+    for experiment in experiments:
+        serialized = json.dumps(experiment, sort_keys = True)
+        fingerprints[experiment_to_laboratory_id(experiment)] = hashlib.sha1(serialized).hexdigest()
+    return fingerprints
+
+class ExperimentMappings(object):
+    """ ExperimentMappings(mappings) -> ExperimentMappings
+
+    Compiled version of the 'mappings' configuration: a dictionary of
+    { 'experiment@category' : 'experiment@category' } where the key is the
+    laboratory identifier shown to the gateway and the value is the real
+    WebLab-Deusto experiment. Both directions are indexed, so the aliases
+    of an experiment can be found without scanning (e.g. in usage reports).
+    """
+
+    def __init__(self, mappings = None):
+        from .weblabdeusto_data import ExperimentId
+        self._forward = {} # alias -> ExperimentId
+        self._reverse = {} # 'experiment@category' -> [ alias ]
+        for alias, target in (mappings or {}).iteritems():
+            experiment_id = ExperimentId.parse(target)
+            self._forward[alias] = experiment_id
+            self._reverse.setdefault(experiment_id.to_weblab_str(), []).append(alias)
+
+        for aliases in self._reverse.itervalues():
+            aliases.sort()
+
+    def resolve(self, laboratory_id):
+        """ resolve(laboratory_id) -> ExperimentId or None """
+        return self._forward.get(laboratory_id)
+
+    def reverse(self, experiment_id):
+        """ reverse(experiment_id) -> [ alias ]
+
+        'experiment_id' may be an ExperimentId or an 'experiment@category' string.
+        """
+        if not isinstance(experiment_id, basestring):
+            experiment_id = experiment_id.to_weblab_str()
+        return list(self._reverse.get(experiment_id, []))
+
+    def iteritems(self):
+        return self._forward.iteritems()
+
+    def __contains__(self, laboratory_id):
+        return laboratory_id in self._forward
+
+    def __len__(self):
+        return len(self._forward)
+
+# mappings configuration string -> ExperimentMappings
+_COMPILED_MAPPINGS = {}
+
+def compile_mappings(mappings_str):
+    """ compile_mappings(mappings_str) -> ExperimentMappings
+
+    The result is cached by the JSON string, so every RLMS instance with
+    the same configuration shares the same compiled table.
+    """
+    mappings_str = mappings_str or '{}'
+    mappings = _COMPILED_MAPPINGS.get(mappings_str)
+    if mappings is None:
+        mappings = _COMPILED_MAPPINGS[mappings_str] = ExperimentMappings(json.loads(mappings_str))
+    return mappings
+
+class Catalogue(object):
+    """ Catalogue(experiments[, laboratory_class[, mappings]]) -> Catalogue
+
+    Built once from the result of list_experiments, it provides hash
+    indexes by laboratory identifier, by category name and by experiment
+    name. 'mappings' is an ExperimentMappings: the aliases whose experiment
+    is available are added as laboratories, resolved to the real
+    ExperimentId so callers do not need to parse them again.
+    """
+
+    def __init__(self, experiments, laboratory_class = None, mappings = None):
+        from .weblabdeusto_data import ExperimentId
+        self.fingerprints  = fingerprint_experiments(experiments)
+        self.laboratories  = []
+        self._by_id        = {} # laboratory_id -> ExperimentId
+        self._laboratories = {} # laboratory_id -> Laboratory
+        self._by_category  = {} # category name -> [ laboratory_id ]
+        self._by_name      = {} # experiment name -> [ laboratory_id ]
+
+        for experiment in experiments:
+            exp_name = experiment['experiment']['name']
+            cat_name = experiment['experiment']['category']['name']
+            laboratory_id = '%s@%s' % (exp_name, cat_name)
+
+            if laboratory_class is None:
+                laboratory = laboratory_id
+            else:
+                laboratory = laboratory_class(laboratory_id, laboratory_id)
+
+            self.laboratories.append(laboratory)
+            self._laboratories[laboratory_id] = laboratory
+            self._by_id[laboratory_id] = ExperimentId(exp_name, cat_name)
+            self._by_category.setdefault(cat_name, []).append(laboratory_id)
+            self._by_name.setdefault(exp_name, []).append(laboratory_id)
+
+        for alias, experiment_id in (mappings or {}).iteritems():
+            target = self._by_id.get(experiment_id.to_weblab_str())
+            if target is None or alias in self._by_id:
+                continue
+
+            if laboratory_class is None:
+                laboratory = alias
+            else:
+                laboratory = laboratory_class(alias, alias)
+
+            self.laboratories.append(laboratory)
+            self._laboratories[alias] = laboratory
+            self._by_id[alias] = target
+
+    def __contains__(self, laboratory_id):
+        return laboratory_id in self._by_id
+
+    def __len__(self):
+        return len(self.laboratories)
+
+    def get_experiment_id(self, laboratory_id):
+        """ get_experiment_id(laboratory_id) -> ExperimentId or None """
+        return self._by_id.get(laboratory_id)
+
+    def get_laboratory(self, laboratory_id):
+        return self._laboratories.get(laboratory_id)
+
+    def get_laboratory_ids_by_category(self, category_name):
+        return list(self._by_category.get(category_name, []))
+
+    def get_laboratory_ids_by_name(self, experiment_name):
+        return list(self._by_name.get(experiment_name, []))
+
+    def get_categories(self):
+        return self._by_category.keys()
+
+class CatalogueEvent(object):
+
+    ADDED   = 'added'
+    CHANGED = 'changed'
+    REMOVED = 'removed'
+
+    def __init__(self, kind, laboratory_id):
+        self.kind          = kind
+        self.laboratory_id = laboratory_id
+
+    def __repr__(self):
+        return "CatalogueEvent(kind = %r, laboratory_id = %r)" % (self.kind, self.laboratory_id)
+
+class CatalogueChanges(object):
+
+    def __init__(self, added = None, changed = None, removed = None):
+        self.added   = added   or []
+        self.changed = changed or []
+        self.removed = removed or []
+
+    def has_changes(self):
+        return len(self.added) > 0 or len(self.changed) > 0 or len(self.removed) > 0
+
+    def events(self):
+        events = []
+        for laboratory_id in self.added:
+            events.append(CatalogueEvent(CatalogueEvent.ADDED, laboratory_id))
+        for laboratory_id in self.changed:
+            events.append(CatalogueEvent(CatalogueEvent.CHANGED, laboratory_id))
+        for laboratory_id in self.removed:
+            events.append(CatalogueEvent(CatalogueEvent.REMOVED, laboratory_id))
+        return events
+
+    def __repr__(self):
+        return "CatalogueChanges(added = %r, changed = %r, removed = %r)" % (self.added, self.changed, self.removed)
+
+def compare_catalogues(old_fingerprints, new_fingerprints):
+    """ compare_catalogues(old_fingerprints, new_fingerprints) -> CatalogueChanges """
+    added   = []
+    changed = []
+    for laboratory_id, fingerprint in new_fingerprints.iteritems():
+        if laboratory_id not in old_fingerprints:
+            added.append(laboratory_id)
+        elif old_fingerprints[laboratory_id] != fingerprint:
+            changed.append(laboratory_id)
+
+    removed = [ laboratory_id for laboratory_id in old_fingerprints if laboratory_id not in new_fingerprints ]
+    return CatalogueChanges(sorted(added), sorted(changed), sorted(removed))
+
+_CATALOGUE_LISTENERS = []
+
+def add_catalogue_listener(listener):
+    """ add_catalogue_listener(listener)
+
+    'listener' is called with a CatalogueEvent every time a refresh detects
+    that a laboratory was added, changed or removed.
+    """
+    _CATALOGUE_LISTENERS.append(listener)
+
+def remove_catalogue_listener(listener):
+    _CATALOGUE_LISTENERS.remove(listener)
+
+def notify_catalogue_changes(changes):
+    for event in changes.events():
+        for listener in list(_CATALOGUE_LISTENERS):
+            listener(event)
+
+class RefreshSchedule(object):
+    """ RefreshSchedule tells the periodic task whether the catalogue should
+    be refreshed or not. Every time the catalogue changes the interval is
+    halved, and every time it does not change it is doubled, always within
+    [MIN_INTERVAL, MAX_INTERVAL] (in seconds).
+    """
+
+    MIN_INTERVAL     =   5 * 60
+    MAX_INTERVAL     = 120 * 60
+    DEFAULT_INTERVAL =  55 * 60
+
+    def __init__(self, interval = DEFAULT_INTERVAL):
+        self.interval     = interval
+        self.next_refresh = 0
+
+    def is_due(self, now = None):
+        if now is None:
+            now = time.time()
+        return now >= self.next_refresh
+
+    def update(self, changed, now = None):
+        if now is None:
+            now = time.time()
+        if changed:
+            self.interval = max(self.MIN_INTERVAL, self.interval / 2)
+        else:
+            self.interval = min(self.MAX_INTERVAL, self.interval * 2)
+        self.next_refresh = now + self.interval
@@ -1,9 +1,13 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import json
+import zlib
 import urllib2
 import cookielib
+import threading
+import collections
+
+from . import weblabdeusto_json
 
 from .weblabdeusto_data import CoordAddress
 from .weblabdeusto_data import SessionId
@@ -11,56 +15,255 @@ from .weblabdeusto_data import Reservation
 from .weblabdeusto_data import Command, NullCommand
 from .weblabdeusto_data import ReservationResult, RunningReservationResult, WaitingReservationResult, CancelledReservationResult, FinishedReservationResult, ExperimentUsage, LoadedFileSent, CommandSent, ExperimentId, ForbiddenReservationResult
 
+class WebLabDeustoError(Exception):
+
+    def __init__(self, message, code = None):
+        super(WebLabDeustoError, self).__init__(message)
+        self.code = code
+
+class SessionNotFoundError(WebLabDeustoError):
+    pass
+
+READ_CHUNK_SIZE = 64 * 1024
+
+def _read_response(uopen):
+    """ Reads the body of the response, decompressing it while it is
+    received if the server used gzip or deflate. """
+    encoding = (uopen.info().get('Content-Encoding') or '').strip().lower()
+    if encoding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        decompressor = None # zlib or raw deflate, depending on the server
+    else:
+        return uopen.read()
+
+    chunks = []
+    while True:
+        chunk = uopen.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        if decompressor is None:
+            try:
+                decompressor = zlib.decompressobj()
+                chunks.append(decompressor.decompress(chunk))
+            except zlib.error:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                chunks.append(decompressor.decompress(chunk))
+        else:
+            chunks.append(decompressor.decompress(chunk))
+
+    if decompressor is not None:
+        chunks.append(decompressor.flush())
+    return ''.join(chunks)
+
+def _parse_command(serialized_command):
+    if not serialized_command:
+        return NullCommand()
+    commandstring = serialized_command.get('commandstring')
+    if commandstring is None or commandstring == {}:
+        return NullCommand()
+    return Command(commandstring)
+
+def _parse_timestamp(serialized_timestamp):
+    if serialized_timestamp is None or serialized_timestamp == {}:
+        return None
+    return serialized_timestamp
+
+def _gzip(content):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(content) + compressor.flush()
+
+class _Request(urllib2.Request):
+    """ urllib2.Request with the CookieJar of the session it belongs to """
+
+    def __init__(self, url, data, headers, cookie_jar):
+        urllib2.Request.__init__(self, url, data = data, headers = headers)
+        self.cookie_jar = cookie_jar
+
+class _SessionCookieProcessor(urllib2.BaseHandler):
+    """ Like urllib2.HTTPCookieProcessor, but using the CookieJar of each
+    request, so a single opener can be shared by all the sessions. """
+
+    def http_request(self, request):
+        cookie_jar = getattr(request, 'cookie_jar', None)
+        if cookie_jar is not None:
+            cookie_jar.add_cookie_header(request)
+        return request
+
+    def http_response(self, request, response):
+        cookie_jar = getattr(request, 'cookie_jar', None)
+        if cookie_jar is not None:
+            cookie_jar.extract_cookies(response, request)
+        return response
+
+    https_request  = http_request
+    https_response = http_response
+
+class _SessionRedirectHandler(urllib2.HTTPRedirectHandler):
+    """ Keeps the CookieJar of the request when following a redirection
+    (e.g. from http to https), since urllib2 builds a plain Request """
+
+    def redirect_request(self, request, fp, code, msg, headers, newurl):
+        new_request = urllib2.HTTPRedirectHandler.redirect_request(self, request, fp, code, msg, headers, newurl)
+        if new_request is not None:
+            new_request.cookie_jar = getattr(request, 'cookie_jar', None)
+        return new_request
+
 class WebLabDeustoClient(object):
+    """ WebLabDeustoClient can be shared by multiple threads. Each session
+    (SessionId returned by login) and each reservation have their own
+    CookieJar, so the cookies used to route the requests to the right
+    WebLab-Deusto server do not get mixed. The lock only protects the
+    dictionaries of CookieJars, never the network calls.
+
+    The CookieJars of the sessions are forgotten when there are too many
+    (the oldest first), but those of the reservations made with
+    reserve_experiment are kept until finished_experiment or
+    forget_reservation is called, since without them the calls would not
+    reach the server handling the reservation. Calls on other reservations
+    start from the default cookies every time.
+
+    The cookies set with set_cookie(s) without a session are the defaults:
+    they are copied to the CookieJar of any session or reservation the
+    client has not seen before (e.g. one restored from a session store).
+    """
 
     LOGIN_SUFFIX = 'login/json/'
     CORE_SUFFIX  = 'json/'
 
-    def __init__(self, baseurl):
+    # Oldest sessions are forgotten after this number
+    MAX_SESSION_COOKIE_JARS = 100
+
+    def __init__(self, baseurl, compress_requests_over = None):
+        """ WebLabDeustoClient(baseurl[, compress_requests_over])
+
+        Responses are always requested compressed (gzip or deflate). If
+        'compress_requests_over' is a number of bytes, bigger requests are
+        sent gzipped too. This is disabled by default, since it requires
+        the web server in front of WebLab-Deusto to support it.
+        """
         self.baseurl         = baseurl
         self.cj              = cookielib.CookieJar()
-        self.opener          = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.cj))
-        self.weblabsessionid = "(not set)"
-
-    def _call(self, url, method, user_agent, **kwargs):
-        request = json.dumps({
-            'method' : method,
-            'params' : kwargs
-        })
-        req = urllib2.Request(url, data = request, headers = {'User-agent' : user_agent or 'WebLab-Deusto'})
+        self.opener          = urllib2.build_opener(_SessionCookieProcessor(), _SessionRedirectHandler())
+        self.compress_requests_over = compress_requests_over
+        self._session_cookie_jars     = collections.OrderedDict() # session id -> CookieJar
+        self._reservation_cookie_jars = {}                        # reservation id -> CookieJar
+        self._cookie_jars_lock        = threading.Lock()
+
+    def _new_cookie_jar(self):
+        cookie_jar = cookielib.CookieJar()
+        for cookie in self.cj:
+            cookie_jar.set_cookie(cookie)
+        return cookie_jar
+
+    def _get_session_cookie_jar(self, session_id, create = True):
+        with self._cookie_jars_lock:
+            cookie_jar = self._session_cookie_jars.pop(session_id, None)
+            if cookie_jar is None:
+                if not create:
+                    return None
+                cookie_jar = self._new_cookie_jar()
+            self._store_session_cookie_jar(session_id, cookie_jar)
+        return cookie_jar
+
+    def _set_session_cookie_jar(self, session_id, cookie_jar):
+        with self._cookie_jars_lock:
+            self._session_cookie_jars.pop(session_id, None)
+            self._store_session_cookie_jar(session_id, cookie_jar)
+
+    def _store_session_cookie_jar(self, session_id, cookie_jar):
+        # Called with the lock acquired
+        self._session_cookie_jars[session_id] = cookie_jar
+        while len(self._session_cookie_jars) > self.MAX_SESSION_COOKIE_JARS:
+            self._session_cookie_jars.popitem(last = False)
+
+    def _get_reservation_cookie_jar(self, reservation_id, create = True):
+        with self._cookie_jars_lock:
+            cookie_jar = self._reservation_cookie_jars.get(reservation_id)
+        if cookie_jar is None and create:
+            # Only the reservations made with reserve_experiment are kept:
+            # others (e.g. made by other process) use the default cookies
+            cookie_jar = self._new_cookie_jar()
+        return cookie_jar
+
+    def _set_reservation_cookie_jar(self, reservation_id, cookie_jar):
+        with self._cookie_jars_lock:
+            self._reservation_cookie_jars[reservation_id] = cookie_jar
+
+    def _get_cookie_jar(self, key, create = True):
+        """ CookieJar of the reservation 'key' if there is one, or of the session 'key' otherwise """
+        if key is None:
+            return self.cj
+        cookie_jar = self._get_reservation_cookie_jar(key, create = False)
+        if cookie_jar is None:
+            cookie_jar = self._get_session_cookie_jar(key, create)
+        return cookie_jar
+
+    def _call(self, url, method, user_agent, cookie_jar, **kwargs):
+        return self._send(url, weblabdeusto_json.encode_request(method, kwargs), user_agent, cookie_jar)
+
+    def _send(self, url, request, user_agent, cookie_jar):
+        headers = {
+            'User-agent'      : user_agent or 'WebLab-Deusto',
+            'Accept-Encoding' : 'gzip, deflate',
+        }
+        if self.compress_requests_over is not None and len(request) > self.compress_requests_over:
+            request = _gzip(request)
+            headers['Content-Encoding'] = 'gzip'
+
+        req = _Request(url, request, headers, cookie_jar)
         uopen = self.opener.open(req)
-        content = uopen.read()
-        cookies = [ c for c in self.cj if c.name == 'weblabsessionid' ]
-        if len(cookies) > 0:
-            self.weblabsessionid = cookies[0].value
-        response = json.loads(content)
+        try:
+            content = _read_response(uopen)
+        finally:
+            uopen.close()
+        response = weblabdeusto_json.loads(content)
         if response.get('is_exception', False):
-            raise Exception(response["message"])
+            code = response.get('code') or ''
+            if code.endswith('SessionNotFound'):
+                raise SessionNotFoundError(response["message"], code)
+            raise WebLabDeustoError(response["message"], code)
         return response['result']
 
-    def _login_call(self, method, user_agent = None, **kwargs):
-        return self._call(self.baseurl + self.LOGIN_SUFFIX, method, user_agent, **kwargs)
+    def _login_call(self, method, cookie_jar, user_agent = None, **kwargs):
+        return self._call(self.baseurl + self.LOGIN_SUFFIX, method, user_agent, cookie_jar, **kwargs)
+
+    def _core_call(self, method, cookie_jar, user_agent = None, **kwargs):
+        return self._call(self.baseurl + self.CORE_SUFFIX, method, user_agent, cookie_jar, **kwargs)
+
+    def _core_reservation_call(self, method, reservation_id, user_agent = None):
+        request = weblabdeusto_json.encode_reservation_request(method, reservation_id.id)
+        return self._send(self.baseurl + self.CORE_SUFFIX, request, user_agent, self._get_reservation_cookie_jar(reservation_id.id))
 
-    def _core_call(self, method, user_agent = None, **kwargs):
-        return self._call(self.baseurl + self.CORE_SUFFIX, method, user_agent, **kwargs)
+    def get_cookies(self, session_id = None):
+        """ get_cookies([session_id]) -> [ cookie ]
 
-    def get_cookies(self):
-        return [ cookie for cookie in self.cj if cookie.name in ['weblabsessionid', 'loginweblabsessionid'] ]
+        'session_id' may be a SessionId or a reservation identifier. Without
+        it, the default cookies are returned.
+        """
+        cookie_jar = self._get_cookie_jar(session_id.id if session_id is not None else None, create = False)
+        if cookie_jar is None:
+            return []
+        return [ cookie for cookie in cookie_jar if cookie.name in ['weblabsessionid', 'loginweblabsessionid'] ]
 
-    def set_cookies(self, cookies):
+    def set_cookies(self, cookies, session_id = None):
+        cookie_jar = self._get_cookie_jar(session_id.id if session_id is not None else None)
         for cookie in cookies:
-            self.cj.set_cookie(cookie)
+            cookie_jar.set_cookie(cookie)
 
-    def set_cookie(self, cookie):
-        self.cj.set_cookie(cookie)
+    def set_cookie(self, cookie, session_id = None):
+        self.set_cookies([ cookie ], session_id)
 
     def login(self, username, password):
-        session_holder = self._login_call('login', username=username, password=password)
-        return SessionId(session_holder['id'])
+        cookie_jar = self._new_cookie_jar()
+        session_holder = self._login_call('login', cookie_jar, username=username, password=password)
+        session_id = SessionId(session_holder['id'])
+        self._set_session_cookie_jar(session_id.id, cookie_jar)
+        return session_id
 
     def list_experiments(self, session_id):
         serialized_session_id = {'id' : session_id.id}
-        experiments_holder = self._core_call('list_experiments', session_id=serialized_session_id)
+        experiments_holder = self._core_call('list_experiments', self._get_session_cookie_jar(session_id.id), session_id=serialized_session_id)
         experiments = self._parse_list_experiments(experiments_holder)
         return experiments
 
@@ -70,19 +273,25 @@ class WebLabDeustoClient(object):
                                 'exp_name' : experiment_id.exp_name,
                                 'cat_name' : experiment_id.cat_name
                             }
-        reservation_holder = self._core_call('reserve_experiment',
+        session_cookie_jar = self._get_session_cookie_jar(session_id.id)
+        # The reservation may be routed to other server, so it has its own cookies
+        cookie_jar = cookielib.CookieJar()
+        for cookie in session_cookie_jar:
+            cookie_jar.set_cookie(cookie)
+        reservation_holder = self._core_call('reserve_experiment', cookie_jar,
                         user_agent = user_agent,
                         session_id=serialized_session_id,
                         experiment_id=serialized_experiment_id,
                         client_initial_data=client_initial_data,
                         consumer_data=consumer_data)
         reservation = self._parse_reservation_holder(reservation_holder)
+        self._set_reservation_cookie_jar(reservation.reservation_id.id, cookie_jar)
         return reservation
 
     def get_experiment_use_by_id(self, session_id, reservation_id):
         serialized_session_id     = {'id' : session_id.id}
         serialized_reservation_id = {'id' : reservation_id.id}
-        experiment_result = self._core_call('get_experiment_use_by_id', session_id = serialized_session_id, reservation_id = serialized_reservation_id)
+        experiment_result = self._core_call('get_experiment_use_by_id', self._get_session_cookie_jar(session_id.id), session_id = serialized_session_id, reservation_id = serialized_reservation_id)
         return self._parse_experiment_result(experiment_result)
 
     def get_experiment_uses_by_id(self, session_id, reservation_ids):
@@ -92,7 +301,7 @@ class WebLabDeustoClient(object):
             serialized_reservation_id = {'id' : reservation_id.id}
             serialized_reservation_ids.append(serialized_reservation_id)
 
-        serialized_experiment_results = self._core_call('get_experiment_uses_by_id', session_id = serialized_session_id, reservation_ids = serialized_reservation_ids)
+        serialized_experiment_results = self._core_call('get_experiment_uses_by_id', self._get_session_cookie_jar(session_id.id), session_id = serialized_session_id, reservation_ids = serialized_reservation_ids)
         experiment_results = []
         for serialized_experiment_result in serialized_experiment_results:
             experiment_result = self._parse_experiment_result(serialized_experiment_result)
@@ -103,18 +312,36 @@ class WebLabDeustoClient(object):
     def send_command(self, reservation_id, command):
         serialized_reservation_id = {'id' : reservation_id.id}
         serialized_command = { 'commandstring' : command.commandstring }
-        response_command = self._core_call('send_command', reservation_id = serialized_reservation_id, command = serialized_command)
-        return Command(response_command['commandstring'] if 'commandstring' in response_command and response_command['commandstring'] is not None else NullCommand())
+        response_command = self._core_call('send_command', self._get_reservation_cookie_jar(reservation_id.id), reservation_id = serialized_reservation_id, command = serialized_command)
+        return _parse_command(response_command)
+
+    def create_command_pipeline(self, reservation_id, max_in_flight = None, ordered = True):
+        """ create_command_pipeline(reservation_id[, max_in_flight[, ordered]]) -> CommandPipeline
+
+        See weblabdeusto_pipeline.CommandPipeline.
+        """
+        from .weblabdeusto_pipeline import CommandPipeline
+        if max_in_flight is None:
+            max_in_flight = CommandPipeline.DEFAULT_MAX_IN_FLIGHT
+        return CommandPipeline(self, reservation_id, max_in_flight, ordered)
 
     def get_reservation_status(self, reservation_id):
-        serialized_reservation_id = {'id' : reservation_id.id}
-        reservation_holder = self._core_call('get_reservation_status',reservation_id=serialized_reservation_id)
+        reservation_holder = self._core_reservation_call('get_reservation_status', reservation_id)
         reservation = self._parse_reservation_holder(reservation_holder)
         return reservation
 
     def finished_experiment(self, reservation_id):
-        serialized_reservation_id = {'id' : reservation_id.id}
-        self._core_call('finished_experiment',reservation_id=serialized_reservation_id)
+        self._core_reservation_call('finished_experiment', reservation_id)
+        self.forget_reservation(reservation_id)
+
+    def forget_reservation(self, reservation_id):
+        """ forget_reservation(reservation_id)
+
+        Drops the cookies of a reservation which finished (or which is not
+        going to be used anymore) without contacting the server.
+        """
+        with self._cookie_jars_lock:
+            self._reservation_cookie_jars.pop(reservation_id.id, None)
 
     def _parse_reservation_holder(self, reservation_holder):
         if reservation_holder.get('remote_reservation_id') is None:
@@ -142,26 +369,15 @@ class WebLabDeustoClient(object):
         addr = experiment_use['coord_address']
         coord_address = CoordAddress(addr['machine_id'],addr['instance_id'],addr['server_id'])
 
-        use = ExperimentUsage(experiment_use['experiment_use_id'], experiment_use['start_date'], experiment_use['end_date'], experiment_use['from_ip'], experiment_id, experiment_use['reservation_id'], coord_address, experiment_use['request_info'])
+        commands = []
+        for command in experiment_use['commands']:
+            commands.append(CommandSent(_parse_command(command['command']), command['timestamp_before'], _parse_command(command['response']), _parse_timestamp(command['timestamp_after'])))
+
+        sent_files = []
         for sent_file in experiment_use['sent_files']:
-            response = Command(sent_file['response']['commandstring']) if 'commandstring' in sent_file['response'] and sent_file['response'] is not None else NullCommand
-            unserialized_sent_file = LoadedFileSent( sent_file['file_content'], sent_file['timestamp_before'], response, sent_file['timestamp_after'], sent_file['file_info'])
-            use.append_file(unserialized_sent_file)
+            sent_files.append(LoadedFileSent(sent_file['file_content'], sent_file['timestamp_before'], _parse_command(sent_file['response']), _parse_timestamp(sent_file['timestamp_after']), sent_file['file_info']))
 
-        for command in experiment_use['commands']:
-            request = Command(command['command']['commandstring']) if 'commandstring' in command['command'] and command['command'] is not None else NullCommand
-            response_command = command['response']['commandstring'] if 'commandstring' in command['response'] and command['response'] is not None else None
-            if response_command is None or response_command == {}:
-                response = NullCommand()
-            else:
-                response = Command(response_command)
-            
-            if command['timestamp_after'] is None or command['timestamp_after'] == {}:
-                timestamp_after = None
-            else:
-                timestamp_after = command['timestamp_after']
-            unserialized_command = CommandSent(request, command['timestamp_before'], response, timestamp_after)
-            use.append_command(unserialized_command)
+        use = ExperimentUsage(experiment_use['experiment_use_id'], experiment_use['start_date'], experiment_use['end_date'], experiment_use['from_ip'], experiment_id, experiment_use['reservation_id'], coord_address, experiment_use['request_info'], commands, sent_files)
         return FinishedReservationResult(use)
 
     def _parse_list_experiments(self, experiments):
@@ -4,6 +4,7 @@
 import re
 import os
 import base64
+import bisect
 
 class CoordException(Exception): pass
 
@@ -363,7 +364,7 @@ class CommandSent(object):
         self.command          = command          # Command
         self.timestamp_before = timestamp_before # seconds.millis since 1970 in GMT
         if response == None:
-            self.response = Command.NullCommand()
+            self.response = NullCommand()
         else:
             self.response = response
         self.timestamp_after = timestamp_after
@@ -389,7 +390,7 @@ class FileSent(object):
         self.file_info        = file_info
         self.timestamp_before = timestamp_before
         if response == None:
-            self.response = Command.NullCommand()
+            self.response = NullCommand()
         else:
             self.response = response
         self.timestamp_after  = timestamp_after
@@ -398,6 +399,66 @@ class FileSent(object):
         content = base64.encodestring(open(os.sep.join((storage_path, self.file_path)), 'rb').read())
         return LoadedFileSent(content, self.timestamp_before, self.response, self.timestamp_after, self.file_info)
 
+def _duration(entry):
+    numbers = (int, long, float)
+    if isinstance(entry.timestamp_before, numbers) and isinstance(entry.timestamp_after, numbers):
+        return entry.timestamp_after - entry.timestamp_before
+    return None
+
+class CommandTimeline(object):
+    """ CommandTimeline(entries) -> CommandTimeline
+
+    Read-only index of the CommandSent (or FileSent) objects of a session,
+    sorted by timestamp_before, so they can be searched by time window
+    with a binary search, or by request or response string. The duration
+    of each entry (timestamp_after - timestamp_before, or None if any of
+    them is missing or not a number) is precomputed in 'durations'.
+    """
+
+    def __init__(self, entries):
+        self.entries    = sorted(entries, key = lambda entry : entry.timestamp_before)
+        self.timestamps = [ entry.timestamp_before for entry in self.entries ]
+        self.durations  = [ _duration(entry) for entry in self.entries ]
+        self._by_request  = None
+        self._by_response = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __getitem__(self, position):
+        return self.entries[position]
+
+    def between(self, start = None, end = None):
+        """ between(start, end) -> [ entry ]
+
+        Entries whose timestamp_before is in [start, end]. Any of them may
+        be None for an open interval.
+        """
+        first = 0 if start is None else bisect.bisect_left(self.timestamps, start)
+        last  = len(self.timestamps) if end is None else bisect.bisect_right(self.timestamps, end)
+        return self.entries[first:last]
+
+    def with_request(self, commandstring):
+        if self._by_request is None:
+            self._by_request = self._index(lambda entry : getattr(entry, 'command', None))
+        return list(self._by_request.get(commandstring, []))
+
+    def with_response(self, commandstring):
+        if self._by_response is None:
+            self._by_response = self._index(lambda entry : entry.response)
+        return list(self._by_response.get(commandstring, []))
+
+    def _index(self, get_command):
+        index = {}
+        for entry in self.entries:
+            command = get_command(entry)
+            if command is not None:
+                index.setdefault(command.commandstring, []).append(entry)
+        return index
+
 class ExperimentUsage(object):
 
     def __init__(self, experiment_use_id = None, start_date = None, end_date = None, from_ip = u"unknown", experiment_id = None, reservation_id = None, coord_address = None, request_info = None, commands = None, sent_files = None):
@@ -423,6 +484,23 @@ class ExperimentUsage(object):
         else:
             self.sent_files         = sent_files
 
+        self._commands_timeline   = None
+        self._sent_files_timeline = None
+
+    def get_commands_timeline(self):
+        """ get_commands_timeline() -> CommandTimeline
+
+        Built on first use, and rebuilt after append_command or update_command.
+        """
+        if self._commands_timeline is None:
+            self._commands_timeline = CommandTimeline(self.commands)
+        return self._commands_timeline
+
+    def get_sent_files_timeline(self):
+        if self._sent_files_timeline is None:
+            self._sent_files_timeline = CommandTimeline(self.sent_files)
+        return self._sent_files_timeline
+
     def append_command(self, command_sent):
         """
         append_command(command_sent)
@@ -436,17 +514,21 @@ class ExperimentUsage(object):
         """
         # isinstance(command_sent, CommandSent)
         self.commands.append(command_sent)
+        self._commands_timeline = None
         return len(self.commands) - 1
 
     def update_command(self, command_id, command_sent):
         self.commands[command_id] = command_sent
+        self._commands_timeline = None
 
     def append_file(self, file_sent):
         self.sent_files.append(file_sent)
+        self._sent_files_timeline = None
         return len(self.sent_files) - 1
 
     def update_file(self, file_id, file_sent):
         self.sent_files[file_id] = file_sent
+        self._sent_files_timeline = None
 
     def load_files(self, path):
         loaded_sent_files = []
@@ -454,6 +536,7 @@ class ExperimentUsage(object):
             loaded_sent_file = sent_file.load(path)
             loaded_sent_files.append(loaded_sent_file)
         self.sent_files = loaded_sent_files
+        self._sent_files_timeline = None
         return self
 
 class ReservationResult(object):
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+
+from flask.ext.wtf import TextField, PasswordField, Required, URL, ValidationError
+
+from labmanager.forms import AddForm, RetrospectiveForm, GenericPermissionForm
+
+class WebLabDeustoAddForm(AddForm):
+
+    DEFAULT_URL      = 'http://www.weblab.deusto.es/'
+    DEFAULT_LOCATION = 'Bilbao, Spain'
+
+    remote_login = TextField("Login",        validators = [Required()])
+    password     = PasswordField("Password")
+
+    base_url     = TextField("Base URL",    validators = [Required(), URL(False) ])
+
+    mappings     = TextField("Mappings",     validators = [Required()], default = "{}")
+
+    def __init__(self, add_or_edit, *args, **kwargs):
+        super(WebLabDeustoAddForm, self).__init__(*args, **kwargs)
+        self.add_or_edit = add_or_edit
+
+    @staticmethod
+    def process_configuration(old_configuration, new_configuration):
+        old_configuration_dict = json.loads(old_configuration)
+        new_configuration_dict = json.loads(new_configuration)
+        if new_configuration_dict.get('password', '') == '':
+            new_configuration_dict['password'] = old_configuration_dict.get('password','')
+        return json.dumps(new_configuration_dict)
+
+    def validate_password(form, field):
+        if form.add_or_edit and field.data == '':
+            raise ValidationError("This field is required.")
+
+    def validate_mappings(form, field):
+        try:
+            content = json.loads(field.data)
+        except:
+            raise ValidationError("Invalid json content")
+        
+        if not isinstance(content, dict):
+            raise ValidationError("Dictionary expected")
+        
+        for key in content:
+            if not isinstance(key, basestring):
+                raise ValidationError("Keys must be strings")
+           
+            if '@' not in key:
+                raise ValidationError("Key format: experiment_name@experiment_category ")
+                
+            value = content[key]
+            if not isinstance(value, basestring):
+                raise ValidationError("Values must be strings")
+           
+            if '@' not in value:
+                raise ValidationError("Value format: experiment_name@experiment_category ")
+
+class WebLabDeustoPermissionForm(RetrospectiveForm):
+    priority = TextField("Priority")
+    time     = TextField("Time (in seconds)")
+
+    def validate_number(form, field):
+        if field.data != '' and field.data is not None:
+            try:
+                int(field.data)
+            except:
+                raise ValidationError("Invalid value. Must be an integer.")
+
+
+    validate_priority = validate_number
+    validate_time     = validate_number
+
+class WebLabDeustoLmsPermissionForm(WebLabDeustoPermissionForm, GenericPermissionForm):
+    pass
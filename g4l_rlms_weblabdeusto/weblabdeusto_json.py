@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+JSON codec used by the client. It builds the JSON-RPC envelopes
+({"method" : ..., "params" : ...}) from precomputed fragments, so only the
+parameters are encoded on each call.
+
+It uses the standard json module unless other backend is configured.
+"""
+
+import json as _backend
+
+BACKEND  = 'json'
+BACKENDS = ('json', 'simplejson', 'ujson')
+
+def configure(backend):
+    """ configure(backend)
+
+    Selects the backend from the WEBLABDEUSTO_JSON_BACKEND setting: None or
+    'json' (default), 'simplejson' or 'ujson'. The others are opt-in since
+    they do not behave exactly as json: in Python 2 simplejson returns str
+    instead of unicode for ASCII strings, and ujson parses floats with less
+    precision by default.
+    """
+    global _backend, BACKEND
+    backend = backend or 'json'
+    if backend not in BACKENDS:
+        raise ValueError("Unsupported JSON backend: %r" % (backend,))
+    _backend = __import__(backend)
+    BACKEND  = backend
+
+def dumps(obj):
+    return _backend.dumps(obj)
+
+def loads(content):
+    return _backend.loads(content)
+
+# method -> '{"method": "<method>", "params": '
+_ENVELOPE_PREFIXES = {}
+
+def encode_request(method, params):
+    """ encode_request(method, params) -> JSON-RPC request body """
+    prefix = _ENVELOPE_PREFIXES.get(method)
+    if prefix is None:
+        prefix = _ENVELOPE_PREFIXES[method] = '{"method": %s, "params": ' % dumps(method)
+    return prefix + dumps(params) + '}'
+
+# method -> ('{"method": "<method>", "params": {"reservation_id": {"id": ', '}}}')
+_RESERVATION_TEMPLATES = {}
+
+def encode_reservation_request(method, reservation_id):
+    """ encode_reservation_request(method, reservation_id) -> JSON-RPC request body
+
+    For methods whose only parameter is the reservation identifier (such as
+    get_reservation_status or finished_experiment), which are called very
+    often and only differ in the identifier.
+    """
+    template = _RESERVATION_TEMPLATES.get(method)
+    if template is None:
+        template = _RESERVATION_TEMPLATES[method] = ('{"method": %s, "params": {"reservation_id": {"id": ' % dumps(method), '}}}')
+    return template[0] + dumps(reservation_id) + template[1]
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import Queue
+import threading
+
+from .weblabdeusto_data import CommandSent
+
+class PipelineClosedError(Exception):
+    pass
+
+class CommandFuture(object):
+    """ Result of a command sent through a CommandPipeline. """
+
+    def __init__(self, command_sent):
+        self.command_sent = command_sent
+        self._event       = threading.Event()
+        self._response    = None
+        self._exception   = None
+
+    @property
+    def command(self):
+        return self.command_sent.command
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout = None):
+        """ result([timeout]) -> Command
+
+        Waits for the response, raising the exception of the call if it failed.
+        """
+        if not self._event.wait(timeout):
+            raise RuntimeError("Timeout waiting for the response to %r" % self.command.commandstring)
+        if self._exception is not None:
+            raise self._exception
+        return self._response
+
+    def exception(self, timeout = None):
+        if not self._event.wait(timeout):
+            raise RuntimeError("Timeout waiting for the response to %r" % self.command.commandstring)
+        return self._exception
+
+    def _set_response(self, response):
+        self._response = response
+        self._event.set()
+
+    def _set_exception(self, exception):
+        self._exception = exception
+        self._event.set()
+
+class CommandPipeline(object):
+    """ CommandPipeline(client, reservation_id[, max_in_flight[, ordered]]) -> CommandPipeline
+
+    Sends the queued commands to the reservation from background threads,
+    so scripts can queue many commands and keep working while they are
+    sent. All the workers share 'client', which is thread-safe.
+
+    This is not HTTP pipelining: each command is a separate HTTP request,
+    and a request is only sent after the response of the previous one in
+    the same worker has arrived. Therefore:
+
+     - By default (ordered = True) there is a single worker, so the server
+       receives the commands in the order they were sent, but throughput
+       is still one command per round-trip.
+     - With ordered = False, up to 'max_in_flight' requests are sent at
+       the same time, so throughput grows with max_in_flight, but two
+       consecutive commands may reach the server in any order.
+
+    In both cases the futures and commands_sent keep the order in which
+    the commands were sent.
+
+    Usage:
+
+        with client.create_command_pipeline(reservation_id) as pipeline:
+            futures = [ pipeline.send(Command('ChangeSwitch on %s' % n)) for n in range(10) ]
+        responses = [ future.result() for future in futures ]
+
+        # Commands which may run in any order, up to 4 at the same time
+        pipeline = client.create_command_pipeline(reservation_id, max_in_flight = 4, ordered = False)
+    """
+
+    DEFAULT_MAX_IN_FLIGHT = 1
+
+    def __init__(self, client, reservation_id, max_in_flight = DEFAULT_MAX_IN_FLIGHT, ordered = True):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        if ordered and max_in_flight > 1:
+            raise ValueError("Ordered pipelines send one command at a time: use ordered = False for max_in_flight > 1")
+
+        self.reservation_id = reservation_id
+        self.commands_sent  = [] # [CommandSent], in the order they were sent
+        self._queue         = Queue.Queue()
+        self._closed        = False
+        self._lock          = threading.Lock()
+        self._workers       = []
+
+        for _ in range(max_in_flight):
+            worker = threading.Thread(target = self._run, args = (client,))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def send(self, command):
+        """ send(command) -> CommandFuture """
+        with self._lock:
+            if self._closed:
+                raise PipelineClosedError("The pipeline has been closed")
+            command_sent = CommandSent(command, None)
+            self.commands_sent.append(command_sent)
+            future = CommandFuture(command_sent)
+            self._queue.put(future)
+        return future
+
+    def send_all(self, commands):
+        """ send_all(commands) -> [ CommandFuture ] """
+        return [ self.send(command) for command in commands ]
+
+    def close(self, wait = True):
+        """ close([wait])
+
+        No more commands are accepted. The queued ones are still sent, and
+        if 'wait' is True, it returns when all of them have finished.
+        """
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                for _ in self._workers:
+                    self._queue.put(None)
+
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _run(self, client):
+        while True:
+            future = self._queue.get()
+            if future is None:
+                return
+
+            command_sent = future.command_sent
+            command_sent.timestamp_before = time.time()
+            try:
+                response = client.send_command(self.reservation_id, command_sent.command)
+            except Exception as e:
+                command_sent.timestamp_after = time.time()
+                future._set_exception(e)
+            else:
+                command_sent.timestamp_after = time.time()
+                command_sent.response = response
+                future._set_response(response)
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+class TrackedReservation(object):
+
+    def __init__(self, configuration, reservation_id, laboratory_id, time_allowed, issued_at):
+        self.configuration  = configuration
+        self.reservation_id = reservation_id # string
+        self.laboratory_id  = laboratory_id
+        self.time_allowed   = time_allowed   # seconds or None
+        self.issued_at      = issued_at
+
+    def may_be_overrun(self, now):
+        # It can not have run past its time before time_allowed seconds since it was issued
+        return self.time_allowed is not None and now - self.issued_at > self.time_allowed
+
+    def __repr__(self):
+        return "TrackedReservation(reservation_id = %r, laboratory_id = %r, time_allowed = %r, issued_at = %r)" % (self.reservation_id, self.laboratory_id, self.time_allowed, self.issued_at)
+
+class ReservationTracker(object):
+    """ ReservationTracker keeps the reservations issued by RLMS.reserve
+    with a time_allowed until they finish, so those which ran past it can
+    be released with finished_experiment as soon as WebLab-Deusto reports
+    them as out of time, instead of waiting until WebLab-Deusto expires
+    them on its own.
+
+    This only shortens that expiry: it does not reclaim the slots of
+    abandoned reservations which still have time left. Reservations are
+    never released for being idle, since the process does not see the
+    activity of the users (they talk to WebLab-Deusto, or to other
+    labmanager processes), and WebLab-Deusto already expires those which
+    are not polled anymore. Reservations without time_allowed are not
+    tracked, since they could never be released.
+    """
+
+    # Reservations are forgotten after this time, whatever their status
+    MAX_TRACKING_TIME = 24 * 3600
+
+    def __init__(self):
+        self._lock         = threading.Lock()
+        self._reservations = {} # reservation_id -> TrackedReservation
+        self._stats        = {
+            'tracked'          : 0,
+            'finished'         : 0,
+            'released_overrun' : 0,
+            'released_seconds' : 0.0, # time the released reservations were held
+            'forgotten'        : 0,
+        }
+
+    def track(self, configuration, reservation_id, laboratory_id, time_allowed, now = None):
+        if time_allowed is None:
+            return
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._reservations[reservation_id] = TrackedReservation(configuration, reservation_id, laboratory_id, time_allowed, now)
+            self._stats['tracked'] += 1
+
+    def get_tracked(self, configuration = None):
+        with self._lock:
+            return [ reservation for reservation in self._reservations.itervalues() if configuration is None or reservation.configuration == configuration ]
+
+    def sweep(self, configuration, client, batch_size = 50, now = None):
+        """ sweep(configuration, client[, batch_size]) -> [ TrackedReservation ]
+
+        Checks the status of the reservations of 'configuration' which may
+        be overrun, and releases them with 'client', up to batch_size per
+        call. Those that already finished (or that have been tracked for
+        too long) are forgotten, and so are their cookies in 'client'.
+        Returns the released reservations.
+        """
+        from .weblabdeusto_data import SessionId, ConfirmedReservation, PostReservationReservation
+        from .weblabdeusto_client import WebLabDeustoError
+
+        if now is None:
+            now = time.time()
+
+        candidates = []
+        for reservation in self.get_tracked(configuration):
+            if now - reservation.issued_at > self.MAX_TRACKING_TIME:
+                self._forget(reservation, 'forgotten')
+                client.forget_reservation(SessionId(reservation.reservation_id))
+            elif reservation.may_be_overrun(now):
+                candidates.append(reservation)
+
+        released = []
+        for reservation in candidates[:batch_size]:
+            reservation_id = SessionId(reservation.reservation_id)
+            try:
+                status = client.get_reservation_status(reservation_id)
+            except WebLabDeustoError:
+                # Not found in WebLab-Deusto anymore
+                self._forget(reservation, 'finished')
+                client.forget_reservation(reservation_id)
+                continue
+            except Exception:
+                # Network error: try again in the next sweep
+                continue
+
+            if isinstance(status, PostReservationReservation):
+                self._forget(reservation, 'finished')
+                client.forget_reservation(reservation_id)
+                continue
+
+            # WebLab-Deusto reports the remaining time of confirmed reservations
+            if not isinstance(status, ConfirmedReservation) or status.time is None or status.time > 0:
+                continue
+
+            try:
+                client.finished_experiment(reservation_id)
+            except Exception:
+                continue
+
+            self._forget(reservation, 'released_overrun', now)
+            released.append(reservation)
+
+        return released
+
+    def get_report(self, now = None):
+        """ get_report() -> dict
+
+        Counters since the process started, plus the reservations currently
+        tracked and for how long they have been held.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            report = dict(self._stats)
+            report['active'] = len(self._reservations)
+            report['active_seconds'] = sum( now - reservation.issued_at for reservation in self._reservations.itervalues() )
+        released = report['released_overrun']
+        report['released'] = released
+        finished = released + report['finished']
+        report['released_ratio'] = 1.0 * released / finished if finished else 0.0
+        return report
+
+    def _forget(self, reservation, reason, now = None):
+        with self._lock:
+            if self._reservations.pop(reservation.reservation_id, None) is None:
+                return
+            self._stats[reason] += 1
+            if reason.startswith('released_'):
+                held = now - reservation.issued_at
+                self._stats['released_seconds'] += held
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+import sqlite3
+import tempfile
+import threading
+
+COOKIE_FIELDS = ('version', 'name', 'value', 'port', 'port_specified', 'domain', 'domain_specified', 'domain_initial_dot', 'path', 'path_specified', 'secure', 'expires', 'discard', 'comment', 'comment_url', 'rfc2109')
+
+def serialize_cookies(cookies):
+    serialized = []
+    for cookie in cookies:
+        serialized_cookie = dict( (field, getattr(cookie, field)) for field in COOKIE_FIELDS )
+        serialized_cookie['rest'] = cookie._rest
+        serialized.append(serialized_cookie)
+    return serialized
+
+def deserialize_cookies(serialized):
+    import cookielib
+    return [ cookielib.Cookie(**serialized_cookie) for serialized_cookie in serialized ]
+
+def session_key(base_url, login):
+    """ session_key(base_url, login) -> key
+
+    All the processes using the same WebLab-Deusto server with the same
+    credentials share the same key, and therefore the same session.
+    """
+    return hashlib.sha1(('%s\n%s' % (base_url, login)).encode('utf8')).hexdigest()
+
+class _FileLock(object):
+    """ Inter-process lock based on flock. It is also held by a
+    threading.Lock, since flock does not exclude the threads of the same
+    process sharing the file descriptor."""
+
+    _thread_locks      = {}
+    _thread_locks_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        with _FileLock._thread_locks_lock:
+            self._thread_lock = _FileLock._thread_locks.setdefault(path, threading.Lock())
+        self._fd = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *args):
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        finally:
+            self._thread_lock.release()
+
+class SessionStore(object):
+    """ SessionStore keeps the SessionId and the cookies returned by the
+    WebLab-Deusto login so every process in the host can reuse them.
+
+    Subclasses must implement _load, _save and _delete, and lock(key), which
+    returns a context manager that excludes other processes logging in
+    with the same key.
+    """
+
+    DEFAULT_MAX_AGE = 30 * 60 # seconds
+
+    def __init__(self, max_age = DEFAULT_MAX_AGE):
+        self.max_age = max_age
+
+    def load(self, key):
+        """ load(key) -> (SessionId, [ cookie ]) or None """
+        from .weblabdeusto_data import SessionId
+
+        stored = self._load(key)
+        if stored is None:
+            return None
+
+        if time.time() - stored['updated'] > self.max_age:
+            return None
+
+        return SessionId(stored['session_id']), deserialize_cookies(stored['cookies'])
+
+    def save(self, key, session_id, cookies):
+        self._save(key, {
+            'session_id' : session_id.id,
+            'cookies'    : serialize_cookies(cookies),
+            'updated'    : time.time(),
+        })
+
+    def invalidate(self, key, session_id):
+        """ invalidate(key, session_id)
+
+        Removes the stored session only if it is still 'session_id', so a
+        session stored in the meanwhile by other process is not lost.
+        """
+        with self.lock(key):
+            stored = self._load(key)
+            if stored is not None and stored['session_id'] == session_id.id:
+                self._delete(key)
+
+    def lock(self, key):
+        raise NotImplementedError("lock not implemented in %s" % type(self).__name__)
+
+    def _load(self, key):
+        raise NotImplementedError("_load not implemented in %s" % type(self).__name__)
+
+    def _save(self, key, data):
+        raise NotImplementedError("_save not implemented in %s" % type(self).__name__)
+
+    def _delete(self, key):
+        raise NotImplementedError("_delete not implemented in %s" % type(self).__name__)
+
+class MemorySessionStore(SessionStore):
+    """ Stores the sessions in the memory of the process, so the threads
+    and RLMS instances of the process share them. It is the default when
+    no WEBLABDEUSTO_SESSION_STORE is configured."""
+
+    def __init__(self, max_age = SessionStore.DEFAULT_MAX_AGE):
+        super(MemorySessionStore, self).__init__(max_age)
+        self._sessions   = {}
+        self._locks      = {}
+        self._locks_lock = threading.Lock()
+
+    def lock(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _load(self, key):
+        return self._sessions.get(key)
+
+    def _save(self, key, data):
+        self._sessions[key] = data
+
+    def _delete(self, key):
+        self._sessions.pop(key, None)
+
+class FileSessionStore(SessionStore):
+    """ Stores each session in a JSON file in 'directory'. Files are replaced
+    atomically, so readers never need to lock."""
+
+    def __init__(self, directory, max_age = SessionStore.DEFAULT_MAX_AGE):
+        super(FileSessionStore, self).__init__(max_age)
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory, 0700)
+
+    def _path(self, key):
+        return os.path.join(self.directory, 'weblabdeusto-%s.json' % key)
+
+    def lock(self, key):
+        return _FileLock(self._path(key) + '.lock')
+
+    def _load(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _save(self, key, data):
+        fd, tmp_path = tempfile.mkstemp(dir = self.directory, prefix = '.weblabdeusto-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp_path, self._path(key))
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def _delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+class SqliteSessionStore(SessionStore):
+    """ Stores the sessions in a table of a SQLite database. Logins are
+    serialized with a lock file next to the database, so the database is
+    never locked during the HTTP request."""
+
+    def __init__(self, path, max_age = SessionStore.DEFAULT_MAX_AGE):
+        super(SqliteSessionStore, self).__init__(max_age)
+        self.path = path
+        # The database holds live sessions, so it is only readable by the owner
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0600))
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS weblabdeusto_sessions (key TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        finally:
+            connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout = 30)
+
+    def lock(self, key):
+        return _FileLock(self.path + '.lock')
+
+    def _load(self, key):
+        connection = self._connect()
+        try:
+            row = connection.execute("SELECT data FROM weblabdeusto_sessions WHERE key = ?", (key,)).fetchone()
+        finally:
+            connection.close()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def _save(self, key, data):
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO weblabdeusto_sessions (key, data) VALUES (?, ?)", (key, json.dumps(data)))
+        finally:
+            connection.close()
+
+    def _delete(self, key):
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("DELETE FROM weblabdeusto_sessions WHERE key = ?", (key,))
+        finally:
+            connection.close()
+
+# url -> SessionStore
+_SESSION_STORES = {}
+_SESSION_STORES_LOCK = threading.Lock()
+
+def get_session_store(url):
+    """ get_session_store(url) -> SessionStore or None
+
+    Supported urls:
+     - memory:// (only shared by the threads of the process)
+     - file:///path/to/directory
+     - sqlite:///path/to/database.db
+    """
+    if not url:
+        return None
+
+    with _SESSION_STORES_LOCK:
+        store = _SESSION_STORES.get(url)
+        if store is None:
+            if url == 'memory://':
+                store = MemorySessionStore()
+            elif url.startswith('file://'):
+                store = FileSessionStore(url[len('file://'):])
+            elif url.startswith('sqlite://'):
+                store = SqliteSessionStore(url[len('sqlite://'):])
+            else:
+                raise ValueError("Unsupported session store: %s" % url)
+            _SESSION_STORES[url] = store
+    return store
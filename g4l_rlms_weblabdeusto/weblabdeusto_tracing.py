@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Optional tracing of the phases of the RLMS entry points (cache lookups,
+login, configuration resolution, JSON, HTTP, URL building...).
+
+    with tracing.span('reserve'):
+        with tracing.span('login'):
+            ...
+
+Spans are nested per thread and sent to the configured exporter when they
+finish. When tracing is disabled (the default), span() returns a shared
+object that does nothing, so the cost is a global lookup and a call.
+"""
+
+import json
+import time
+import logging
+import threading
+import collections
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def set(self, key, value):
+        pass
+
+NULL_SPAN = _NullSpan()
+
+_exporter = None
+_local    = threading.local()
+
+class Span(object):
+
+    def __init__(self, exporter, name):
+        self.exporter   = exporter
+        self.name       = name
+        self.attributes = {}
+        self.parent     = None
+        self.path       = name
+        self.start      = None
+        self.end        = None
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        if stack:
+            self.parent = stack[-1]
+            self.path   = self.parent.path + '/' + self.name
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time.time()
+        if exc_type is not None:
+            self.attributes['error'] = '%s: %s' % (exc_type.__name__, exc_value)
+        _local.stack.pop()
+        self.exporter.export(self)
+
+    def to_dict(self):
+        return {
+            'name'       : self.name,
+            'path'       : self.path,
+            'start'      : self.start,
+            'duration'   : self.duration,
+            'attributes' : self.attributes,
+        }
+
+def span(name):
+    """ span(name) -> context manager """
+    exporter = _exporter
+    if exporter is None:
+        return NULL_SPAN
+    return Span(exporter, name)
+
+class RingBufferExporter(object):
+    """ Keeps the last 'size' spans in memory. """
+
+    def __init__(self, size = 1000):
+        self._spans = collections.deque(maxlen = size)
+
+    def export(self, span):
+        self._spans.append(span)
+
+    def get_spans(self):
+        return [ span.to_dict() for span in list(self._spans) ]
+
+class LoggingExporter(object):
+    """ Logs each span as a JSON document. """
+
+    def __init__(self, logger_name = 'g4l_rlms_weblabdeusto.tracing', level = logging.INFO):
+        self.logger = logging.getLogger(logger_name)
+        self.level  = level
+
+    def export(self, span):
+        self.logger.log(self.level, json.dumps(span.to_dict()))
+
+def enable(exporter):
+    """ enable(exporter)
+
+    'exporter' is any object with an export(span) method.
+    """
+    global _exporter
+    _exporter = exporter
+
+def disable():
+    global _exporter
+    _exporter = None
+
+def get_exporter():
+    return _exporter
+
+def configure(setting):
+    """ configure(setting)
+
+    Configures tracing from the WEBLABDEUSTO_TRACING setting: None (disabled),
+    'memory' (RingBufferExporter), 'log' (LoggingExporter) or an exporter.
+    """
+    if not setting:
+        disable()
+    elif setting == 'memory':
+        enable(RingBufferExporter())
+    elif setting == 'log':
+        enable(LoggingExporter())
+    elif hasattr(setting, 'export'):
+        enable(setting)
+    else:
+        raise ValueError("Unsupported tracing setting: %r" % (setting,))
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import threading
+
+DEFAULT_LOCALE = 'en'
+
+def locale_fallbacks(locale, default = DEFAULT_LOCALE):
+    """ locale_fallbacks(locale) -> [ locale, ... ]
+
+    Returns the chain of locales to be checked, from the most specific to
+    the default one. For instance: 'es-ES' -> ['es_ES', 'es', 'en'].
+    """
+    chain = []
+    if locale:
+        locale = locale.replace('-', '_')
+        chain.append(locale)
+        if '_' in locale:
+            chain.append(locale.split('_')[0])
+    if default not in chain:
+        chain.append(default)
+    return chain
+
+class TranslationIndex(object):
+    """ TranslationIndex shares the strings of the translations documents
+    retrieved from WebLab-Deusto ({ 'translations' : { locale : { key : message } }, 'mails' : ... })
+    among all the laboratories, so the same message is stored only once,
+    and slices them by (laboratory_id, locale), so only the strings of one
+    language are returned to the callers.
+
+    The documents are owned by the caller (e.g. the RLMS cache), which may
+    return copies of them (e.g. if it serializes its values): slices are
+    reused as long as the document is equal to the one they come from.
+    The strings of a laboratory are released when its document is replaced
+    or removed.
+    """
+
+    MAX_SLICES = 1000
+
+    def __init__(self, default_locale = DEFAULT_LOCALE):
+        self.default_locale = default_locale
+        self._lock       = threading.Lock()
+        # string -> shared string
+        self._strings    = {}
+        # shared string -> number of laboratories using it
+        self._references = {}
+        # laboratory_id -> strings of its document
+        self._laboratory_strings = {}
+        # (laboratory_id, locale) -> (document, sliced translations document)
+        self._slices     = {}
+
+    def add(self, laboratory_id, document):
+        """ add(laboratory_id, document) -> document
+
+        The strings of the document are replaced in place by the shared
+        ones, so the returned document can be cached by the caller without
+        duplicating them.
+        """
+        with self._lock:
+            strings = set()
+            document = self._share(document, strings)
+            strings = tuple(strings)
+            for string in strings:
+                self._references[string] = self._references.get(string, 0) + 1
+
+            self._forget(laboratory_id)
+            self._laboratory_strings[laboratory_id] = strings
+        return document
+
+    def remove(self, laboratory_id):
+        with self._lock:
+            self._forget(laboratory_id)
+
+    def get(self, laboratory_id, locale, document):
+        """ get(laboratory_id, locale, document) -> sliced document """
+        key = (laboratory_id, locale)
+        entry = self._slices.get(key)
+        if entry is not None and (entry[0] is document or entry[0] == document):
+            return entry[1]
+
+        sliced = self._slice(document, locale)
+        with self._lock:
+            # The locale comes from the client, so the slices are bounded
+            if len(self._slices) >= self.MAX_SLICES:
+                self._slices.clear()
+            self._slices[key] = (document, sliced)
+        return sliced
+
+    def _slice(self, document, locale):
+        translations = document.get('translations') or {}
+        messages = {}
+        # From the most generic to the most specific one, so the latter wins
+        for fallback in reversed(locale_fallbacks(locale, self.default_locale)):
+            messages.update(translations.get(fallback) or {})
+
+        sliced = dict(document)
+        sliced['translations'] = { locale : messages }
+        return sliced
+
+    def _forget(self, laboratory_id):
+        # Called with the lock acquired
+        for string in self._laboratory_strings.pop(laboratory_id, ()):
+            references = self._references[string] - 1
+            if references:
+                self._references[string] = references
+            else:
+                del self._references[string]
+                del self._strings[string]
+        for key in [ key for key in self._slices if key[0] == laboratory_id ]:
+            del self._slices[key]
+
+    def _share(self, value, strings):
+        if isinstance(value, basestring):
+            value = self._strings.setdefault(value, value)
+            strings.add(value)
+            return value
+        if isinstance(value, dict):
+            for key in value.keys():
+                value[self._share(key, strings)] = self._share(value.pop(key), strings)
+            return value
+        if isinstance(value, list):
+            value[:] = [ self._share(element, strings) for element in value ]
+            return value
+        return value
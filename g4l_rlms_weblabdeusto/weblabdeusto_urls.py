@@ -0,0 +1,50 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import urllib
+
+def _quote(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    return urllib.quote(str(value), safe = '')
+
+class UrlBuilder(object):
+    """ UrlBuilder(base_url) -> UrlBuilder
+
+    Builds the URLs of a WebLab-Deusto server from fragments computed once,
+    URL-encoding every value (reservation identifiers, widget names, back
+    URLs, locales, experiment and category names).
+    """
+
+    def __init__(self, base_url):
+        if not base_url.endswith('/'):
+            base_url += '/'
+        self.base_url       = base_url
+        self._federated     = base_url + 'federated/?reservation_id='
+        self._i18n          = base_url + 'web/i18n/'
+
+    def load_url(self, reservation_id, back, locale = None):
+        url = self._federated + _quote(reservation_id) + '&back_url=' + _quote(back)
+        if locale is not None:
+            url += '&locale=' + _quote(locale)
+        return url
+
+    def widget_url(self, reservation_id, widget_name, back, locale = None):
+        url = self._federated + _quote(reservation_id) + '&widget=' + _quote(widget_name) + '&back_url=' + _quote(back)
+        if locale is not None:
+            url += '&locale=' + _quote(locale)
+        return url
+
+    def translations_url(self, experiment_id):
+        return self._i18n + _quote(experiment_id.cat_name) + '/' + _quote(experiment_id.exp_name) + '/'
+
+# base_url -> UrlBuilder
+_URL_BUILDERS = {}
+
+def get_url_builder(base_url):
+    builder = _URL_BUILDERS.get(base_url)
+    if builder is None:
+        builder = _URL_BUILDERS[base_url] = UrlBuilder(base_url)
+    return builder